@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Compares the original per-pixel python loop used to decode a spectrum frame
+# against the vectorized decodeFrame in Spectrometer_Core.py, then times the
+# packed 12-bit and delta coded frame decoders.
+# Run with 'python3 Benchmarks/Decode_Benchmark.py'
+
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectrometer_Core import decodeFrame, decodePayload, pack12, deltaCode
+
+
+# This is how Spec_Duino.read used to decode each frame
+def loopDecode(stream):
+    data = np.zeros(2048)
+    for i in range(2048):
+        data[i] = stream[2*i] << 8 | stream[2*i+1]
+    return data
+
+
+def main(repeats=200):
+    raw = np.random.randint(0, 4096, 2048).astype('>u2')
+    stream = raw.tobytes()
+    frame = np.zeros(2048, float)
+    if not np.array_equal(loopDecode(stream), decodeFrame(stream, frame)):
+        print("**Decoders Disagree**")
+        return
+    loop_time = timeit.timeit(lambda: loopDecode(stream),
+                              number=repeats) / repeats
+    fast_time = timeit.timeit(lambda: decodeFrame(stream, frame),
+                              number=repeats) / repeats
+    print("Python loop decode:  {0:9.2f} us/frame".format(loop_time * 10**6))
+    print("Vectorized decode:   {0:9.2f} us/frame".format(fast_time * 10**6))
+    print("Speedup:             {0:9.1f} x".format(loop_time / fast_time))
+    # A smooth spectrum with a little noise, like a real one
+    pixels = np.arange(2048)
+    smooth = (1000 + 3000 * np.exp(-((pixels - 1024) / 200.)**2) +
+              np.random.randint(0, 16, 2048)).astype(int)
+    for name, encoding, stream in [("Packed 12-bit", 1, pack12(smooth)),
+                                   ("Delta", 2, deltaCode(smooth))]:
+        decodePayload(stream, encoding, frame)
+        if not np.array_equal(frame, smooth):
+            print("**{} Decoder Disagrees**".format(name))
+            return
+        decode_time = timeit.timeit(
+            lambda: decodePayload(stream, encoding, frame),
+            number=repeats) / repeats
+        print("{0:14s} decode: {1:9.2f} us/frame, {2} bytes "
+              "({3:.0f}% of plain)".format(name, decode_time * 10**6,
+                                           len(stream),
+                                           100. * len(stream) / 4096))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Measures how many peak fits per second each fit engine in
+# Spectrometer_Core.py manages on dummy spectra, alongside the original
+# full-range curve_fit.
+# Run with 'python3 Benchmarks/Fit_Benchmark.py'
+
+import os
+import sys
+import time
+import numpy as np
+from scipy.optimize import curve_fit as fit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectrometer_Core import FIT_ENGINES, fitPeak, gaussian, estimatePeak, \
+    refinePeak
+
+
+# This is how findFit used to fit every spectrum
+def fullFit(x, y):
+    guesses = [np.amax(y), x[1024], 80 * 10.0**-9.0, 2.5]
+    try:
+        fit_vals, cov = fit(gaussian, x, y, p0=guesses)
+    except RuntimeError:
+        return None
+    return fit_vals
+
+
+# The Refined Fit engine, but counting a failure as one. refinePeak falls
+# back to the estimate it started from when curve_fit fails, so fitPeak
+# would never return None for it.
+def refinedFit(x, y):
+    guesses = estimatePeak(x, y)
+    if guesses is None:
+        return None
+    fit_vals = refinePeak(x, y, guesses)
+    if fit_vals is guesses:
+        return None
+    return fit_vals
+
+
+def makeSpectra(x, count):
+    spectra = []
+    for i in range(count):
+        center = np.random.uniform(x[300], x[-300])
+        fwhm = np.random.uniform(5, 40) * 10**-9
+        spectra.append(gaussian(x, 3500., center, fwhm, 2.0) +
+                       np.random.uniform(0, 100, len(x)))
+    return spectra
+
+
+def main(count=200):
+    x = np.array(range(3000, 9000, 2))[:2048]/8000000000.0
+    spectra = makeSpectra(x, count)
+    methods = [(FIT_ENGINES[0], lambda y: fitPeak(x, y, FIT_ENGINES[0])),
+               (FIT_ENGINES[1], lambda y: refinedFit(x, y))]
+    methods.append(("Original Full Fit", lambda y: fullFit(x, y)))
+    for name, method in methods:
+        start = time.perf_counter()
+        failures = 0
+        for y in spectra:
+            if method(y) is None:
+                failures += 1
+        elapsed = time.perf_counter() - start
+        print("{0:18s} {1:10.1f} fits/s   {2} of {3} failed"
+              .format(name, count / elapsed, failures, count))
+
+
+if __name__ == "__main__":
+    main()
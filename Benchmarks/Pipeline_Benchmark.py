@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+# Drives the whole acquisition path headlessly against the simulated
+# spectrometer: reading and decoding each spectrum in Spec_Duino.read, the
+# blank subtraction and other corrections of Correction_Pipeline, the fits
+# findFit asks for, and writing and parsing the .csv files of saveCurve and
+# importCurve. Reports the latency percentiles of each stage, the spectra
+# per second of the acquire, correct and fit chain and of a free-running
+# stream, and the memory each stage allocates per spectrum. The results are
+# saved as JSON, and --compare prints how they differ from an earlier run.
+# Run with 'python3 Benchmarks/Pipeline_Benchmark.py', or add --help
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectrometer_Core import Correction_Pipeline, FIT_ENGINES, \
+    Simulated_Spec_Duino, defaultCalibration, detector_Geometry, fitPeak, \
+    fitPeaks, formatHeader, i_Time, link_Status, parseColumns, port_Status, \
+    spec_Duino, spec_Port, spectrum, writeSpectrumCsv
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FOLDER = os.path.join(BENCHMARK_FOLDER, "Results")
+# A native USB spectrometer with no integration wait, so the host is what
+# limits the rate. The seed keeps the spectra the same from run to run.
+DEFAULT_URL = "sim://?features=FSUPD&time_scale=0&usb_rate=1e9&seed=1"
+
+
+# One spectrum's trip through each stage, in order. The decode inside read
+# is timed on its own by wrapping Spec_Duino.decodeFramed.
+class Pipeline_Run(object):
+
+    def __init__(self, save_folder):
+        n_pixels = len(spec_Duino.frame)
+        full_scale = 2**detector_Geometry.read()[1] - 1
+        self.calibration = defaultCalibration(n_pixels)
+        self.blank = np.full(n_pixels, Simulated_Spec_Duino.DARK_LEVEL, float)
+        self.pipeline = Correction_Pipeline(n_pixels, full_scale)
+        self.pipeline.dark = self.blank
+        self.pipeline.nonlinearity = [1e-6, 1.0, 0.0]
+        self.pipeline.setFlat(np.random.default_rng(1).uniform(0.9, 1.1,
+                                                               n_pixels))
+        self.csv_path = os.path.join(save_folder, "benchmark.csv")
+        self.data = None
+        self.decode_times = []
+        decode = spec_Duino.decodeFramed
+
+        def timedDecode(frame):
+            start = time.perf_counter()
+            decoded = decode(frame)
+            self.decode_times.append(time.perf_counter() - start)
+            return decoded
+        spec_Duino.decodeFramed = timedDecode
+        self.stages = [["read", self.read], ["correct", self.correct],
+                       ["fit_fast", self.fitFast],
+                       ["fit_refined", self.fitRefined],
+                       ["fit_peaks", self.fitPeaks],
+                       ["csv_write", self.writeCsv],
+                       ["csv_parse", self.parseCsv]]
+
+    def read(self):
+        spec_Duino.read()
+
+    def correct(self):
+        self.pipeline.run(spectrum.readLatest()[0])
+        self.data = self.pipeline.filled()
+
+    def fitFast(self):
+        fitPeak(self.calibration, self.data, FIT_ENGINES[0])
+
+    def fitRefined(self):
+        fitPeak(self.calibration, self.data, FIT_ENGINES[1])
+
+    def fitPeaks(self):
+        fitPeaks(self.calibration, self.data, FIT_ENGINES[0], 200, 5)
+
+    def writeCsv(self):
+        header = formatHeader(time.time(), i_Time.read(), 0.0, 0.0, 0.0,
+                              0.0, 0.0)
+        writeSpectrumCsv(self.csv_path, header, self.calibration,
+                         self.pipeline.corrected, self.blank)
+
+    def parseCsv(self):
+        parseColumns(self.csv_path)
+
+    def time(self, n_frames):
+        times = dict((name, []) for name, stage in self.stages)
+        del self.decode_times[:]
+        for index in range(n_frames):
+            for name, stage in self.stages:
+                start = time.perf_counter()
+                stage()
+                times[name].append(time.perf_counter() - start)
+        times["decode"] = list(self.decode_times)
+        return times
+
+    # The peak memory each stage allocates beyond what was already in use,
+    # and what it still holds afterwards, per spectrum
+    def allocations(self, n_frames):
+        peaks = dict((name, []) for name, stage in self.stages)
+        retained = dict((name, []) for name, stage in self.stages)
+        tracemalloc.start()
+        for index in range(n_frames):
+            for name, stage in self.stages:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                stage()
+                current, peak = tracemalloc.get_traced_memory()
+                peaks[name].append(peak - before)
+                retained[name].append(current - before)
+        tracemalloc.stop()
+        return peaks, retained
+
+
+# Spectra per second while free running, for seconds
+def streamRate(seconds):
+    if "S" not in spec_Duino.features:
+        return None
+    first = spectrum.next_sequence
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        spec_Duino.streamStep()
+    elapsed = time.perf_counter() - start
+    spec_Duino.stopStream()
+    return (spectrum.next_sequence - first) / elapsed
+
+
+def summarize(seconds):
+    microseconds = np.array(seconds) * 10**6
+    return {"count": len(microseconds),
+            "mean_us": float(np.mean(microseconds)),
+            "p50_us": float(np.percentile(microseconds, 50)),
+            "p90_us": float(np.percentile(microseconds, 90)),
+            "p99_us": float(np.percentile(microseconds, 99)),
+            "max_us": float(np.max(microseconds)),
+            "per_second": float(10**6 / np.mean(microseconds))}
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_FOLDER,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def run(url, n_frames, n_traced, stream_seconds, i_time):
+    spec_Port.write(url)
+    spec_Duino.connectPort()
+    if not port_Status.read()[1]:
+        raise ConnectionError("Could not connect to " + url)
+    i_Time.write(i_time)
+    with tempfile.TemporaryDirectory() as save_folder:
+        pipeline_run = Pipeline_Run(save_folder)
+        pipeline_run.time(min(10, n_frames))  # Warm up, and import scipy
+        times = pipeline_run.time(n_frames)
+        peaks, retained = pipeline_run.allocations(n_traced)
+    stages = {}
+    for name, seconds in times.items():
+        stages[name] = summarize(seconds)
+        if name in peaks:
+            stages[name]["alloc_peak_bytes"] = float(np.mean(peaks[name]))
+            stages[name]["retained_bytes"] = float(np.mean(retained[name]))
+    # What free running does for each spectrum it shows
+    chain = np.sum([times[name] for name in ["read", "correct", "fit_fast"]],
+                   axis=0)
+    stream_fps = streamRate(stream_seconds)
+    crc_errors, skipped_bytes, lost_frames = link_Status.read()
+    spec_Duino.closePort()
+    return {"revision": revision(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "url": url, "frames": n_frames, "i_time": i_time,
+            "frames_per_second": float(1 / np.mean(chain)),
+            "chain": summarize(chain),
+            "stream_frames_per_second": stream_fps,
+            "link_errors": crc_errors + lost_frames,
+            "stages": stages}
+
+
+def report(results, previous=None):
+    print("Revision {revision}, {frames} spectra from {url}".format(**results))
+    print("{0:12s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>12s}"
+          .format("Stage", "p50 us", "p90 us", "p99 us", "per s",
+                  "alloc bytes"))
+    rows = sorted(results["stages"].items()) + [["chain", results["chain"]]]
+    for name, stage in rows:
+        line = ("{0:12s} {1[p50_us]:10.1f} {1[p90_us]:10.1f} "
+                "{1[p99_us]:10.1f} {1[per_second]:10.1f} {2:>12s}"
+                .format(name, stage, "{:.0f}".format(stage["alloc_peak_bytes"])
+                        if "alloc_peak_bytes" in stage else "--"))
+        if previous is not None:
+            old = previous["stages"].get(name, previous.get(name))
+            if old is not None:
+                change = stage["p50_us"] / old["p50_us"] - 1
+                line += "  {0:+6.1%}{1}".format(change,
+                                                " *" if change > 0.1 else "")
+        print(line)
+    print("Acquire, correct and fit:  {0:.1f} spectra/s".format(
+        results["frames_per_second"]))
+    if results["stream_frames_per_second"] is not None:
+        print("Free-running stream:       {0:.1f} spectra/s".format(
+            results["stream_frames_per_second"]))
+    if previous is not None:
+        print("Changes are in the p50 latency against revision {}, with a * "
+              "where it is over 10% slower".format(previous["revision"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the acquisition path, stage by stage")
+    parser.add_argument("--url", default=DEFAULT_URL,
+                        help="spectrometer port or URL (default: {})"
+                        .format(DEFAULT_URL))
+    parser.add_argument("--frames", type=int, default=300,
+                        help="spectra to time each stage over")
+    parser.add_argument("--traced", type=int, default=20,
+                        help="spectra to trace allocations over")
+    parser.add_argument("--stream-seconds", type=float, default=2.0,
+                        help="how long to time free running for")
+    parser.add_argument("--i-time", type=int, default=20,
+                        help="integration time in ms")
+    parser.add_argument("--json", help="where to save the results (default: "
+                        "a new file in Benchmarks/Results)")
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args(argv)
+    results = run(args.url, args.frames, args.traced, args.stream_seconds,
+                  args.i_time)
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    report(results, previous)
+    save_path = args.json
+    if save_path is None:
+        if not os.path.isdir(RESULTS_FOLDER):
+            os.mkdir(RESULTS_FOLDER)
+        save_path = os.path.join(RESULTS_FOLDER, "Pipeline_{}_{}.json".format(
+            time.strftime("%Y-%m-%d_%H%M%S"), results["revision"]))
+    with open(save_path, "w") as save_file:
+        json.dump(results, save_file, indent=2)
+    print("Results saved to " + save_path)
+
+
+if __name__ == "__main__":
+    main()
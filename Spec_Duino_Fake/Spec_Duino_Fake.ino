@@ -7,29 +7,227 @@
 */
 
 
+// Set NATIVE_USB to 1 to talk over the Due's native USB port, which runs
+// at full USB speed whatever the baud rate. Otherwise the programming port
+// is used, and the UI may move it to a faster baud rate (see readCommand).
+#define NATIVE_USB 0
+#if NATIVE_USB
+#define LINK SerialUSB
+#define FEATURES "FSUPD"
+#else
+#define LINK Serial
+#define FEATURES "FSBPD"
+#endif
+
+long baud = 115200; // The last baud rate the UI confirmed
+long new_baud = 115200; // A rate the UI is still trying out
+unsigned long baud_changed = 0; // When new_baud was set, or 0 once settled
+const unsigned long BAUD_CONFIRM_TIME = 3000;
+
 void setup(){
-  Serial.begin(115200);
+  LINK.begin(baud);
   establishContact();
 }
 
-void loop(){
-  if (Serial.available() > 0){
-    int integration_time = Serial.parseInt();
-    while (Serial.available() > 0 ){
-      Serial.read(); // Clear the serial buffer
+// The Due's unsigned int is 32 bits, so sixteen scans can be summed in it.
+// This and the frame buffer below take about 10 kB, so this sketch needs a
+// Due rather than an AVR board.
+unsigned int sum[2048];
+
+// Each spectrum goes out as one frame: a sync word, a header, the pixels,
+// then a CRC-16 (CCITT, 0x1021 from 0xFFFF) of the header and pixels. The
+// header holds a sequence number, the integration time and scan count used,
+// the pixel data length and its encoding (see below). Everything is high
+// byte first. See Hardware_Notes.md.
+const byte SYNC[4] = {0xA5, 0x5A, 'S', 'P'};
+const int HEADER_SIZE = 16;
+byte frame[HEADER_SIZE + 3 * 2048 + 2]; // Room for the worst delta coding
+unsigned int sequence = 0;
+
+unsigned int crc16(byte *bytes, int length){
+  unsigned int crc = 0xFFFF;
+  for (int i = 0; i < length; i++){
+    crc ^= (unsigned int)bytes[i] << 8;
+    for (int k = 0; k < 8; k++){
+      crc = (crc & 0x8000) ? ((crc << 1) ^ 0x1021) : (crc << 1);
     }
+    crc &= 0xFFFF;
+  }
+  return crc;
+}
+
+int putBytes(int at, unsigned long value, int count){
+  for (int k = count - 1; k >= 0; k--){
+    frame[at++] = byte(value >> (8 * k));
+  }
+  return at;
+}
+
+// Pixel encodings, as numbers in the frame header. PACKED puts two 12-bit
+// pixels in three bytes. DELTA sends each pixel's difference from the one
+// before, zigzag mapped, seven bits per byte with the high bit set on all
+// but the last. DELTA falls back to PACKED or PLAIN for any spectrum it
+// would make longer, and PACKED falls back to PLAIN for any spectrum with
+// a pixel over 12 bits.
+const byte PLAIN = 0;
+const byte PACKED = 1;
+const byte DELTA = 2;
+byte encoding = PLAIN; // Set by the UI with "E encoding"
+
+int encodePixels(int at, int n_pixels, byte used){
+  if (used == PACKED){
+    for (int i = 0; i < n_pixels; i += 2){
+      unsigned int a = sum[i];
+      unsigned int b = (i + 1 < n_pixels) ? sum[i + 1] : 0;
+      frame[at++] = byte(a >> 4);
+      frame[at++] = byte((a << 4) | (b >> 8));
+      frame[at++] = byte(b);
+    }
+  }
+  else if (used == DELTA){
+    long previous = 0;
+    for (int i = 0; i < n_pixels; i++){
+      long delta = (long)sum[i] - previous;
+      previous = sum[i];
+      unsigned long zigzag = (delta < 0) ? ((unsigned long)(-delta) << 1) - 1
+                                         : (unsigned long)delta << 1;
+      while (zigzag >= 0x80){
+        frame[at++] = byte(zigzag | 0x80);
+        zigzag >>= 7;
+      }
+      frame[at++] = byte(zigzag);
+    }
+  }
+  else{
+    for (int i = 0; i < n_pixels; i++){
+      at = putBytes(at, sum[i], 2);
+    }
+  }
+  return at;
+}
+
+void sendFrame(int i_time, int n_sum, int n_pixels){
+  unsigned int highest = 0; // Sums, and bright pixels, can pass 12 bits
+  for (int i = 0; i < n_pixels; i++){
+    if (sum[i] > highest) highest = sum[i];
+  }
+  byte fallback = (highest > 4095) ? PLAIN : PACKED;
+  byte used = (encoding == DELTA) ? DELTA : min(encoding, fallback);
+  int at = encodePixels(HEADER_SIZE, n_pixels, used);
+  int fallback_length = (fallback == PACKED) ? 3 * ((n_pixels + 1) / 2)
+                                             : 2 * n_pixels;
+  if (used == DELTA && at - HEADER_SIZE > fallback_length){
+    used = fallback;
+    at = encodePixels(HEADER_SIZE, n_pixels, used);
+  }
+  int head = 0;
+  for (int k = 0; k < 4; k++){
+    frame[head++] = SYNC[k];
+  }
+  head = putBytes(head, sequence++, 2);
+  head = putBytes(head, i_time, 4);
+  head = putBytes(head, at - HEADER_SIZE, 4);
+  head = putBytes(head, n_sum, 1);
+  head = putBytes(head, used, 1);
+  at = putBytes(at, crc16(frame + 4, at - 4), 2);
+  LINK.write(frame, at);
+}
+
+bool streaming = false;
+int integration_time = 100;
+int n_sum = 1; // Spectra to sum before sending
+
+void loop(){
+  if (baud_changed != 0 && millis() - baud_changed > BAUD_CONFIRM_TIME){
+    LINK.end(); // The UI never confirmed the new rate, so go back
+    LINK.begin(baud);
+    baud_changed = 0;
+  }
+  if (LINK.available() > 0){
+    readCommand();
+  }
+  if (streaming){
+    acquire();
+    sendFrame(integration_time, n_sum, 2048);
+  }
+  else{
+    delay(2);
+  }
+}
+
+// "S i_time n_sum" starts streaming spectra back to back, "I i_time n_sum"
+// changes the settings mid-stream and "X" stops the stream, answered by an
+// empty frame. A bare "i_time n_sum" asks for a single spectrum. "B rate"
+// switches to a new baud rate, which "K" confirms once the UI has seen
+// spectra arrive intact, "E encoding" picks the pixel encoding and "H"
+// repeats the handshake.
+void readCommand(){
+  char command = LINK.peek();
+  if (command == 'S' || command == 'I' || command == 'X' ||
+      command == 'B' || command == 'K' || command == 'H' ||
+      command == 'E'){
+    LINK.read();
+  }
+  if (command == 'B'){
+    new_baud = LINK.parseInt();
+    LINK.flush();
+    LINK.end();
+    LINK.begin(new_baud);
+    baud_changed = millis();
+    return;
+  }
+  if (command == 'K'){
+    baud = new_baud;
+    baud_changed = 0;
+    return;
+  }
+  if (command == 'E'){
+    encoding = LINK.parseInt();
+    if (encoding > DELTA) encoding = PLAIN;
+    return;
+  }
+  if (command == 'H'){
+    establishContact();
+    return;
+  }
+  if (command == 'X'){
+    streaming = false;
+    sendFrame(integration_time, 0, 0);
+    return;
+  }
+  integration_time = LINK.parseInt();
+  n_sum = LINK.parseInt();
+  while (LINK.peek() == ' '){
+    LINK.read(); // Leave any command that follows in the buffer
+  }
+  if (n_sum < 1) n_sum = 1;
+  if (n_sum > 16) n_sum = 16; // 16 12-bit spectra still fit in 16 bits
+  if (command == 'S'){
+    streaming = true;
+  }
+  else if (command != 'I'){
+    acquire();
+    sendFrame(integration_time, n_sum, 2048);
+  }
+}
+
+void acquire(){
+  for (int i = 0; i < 2048; i++){
+    sum[i] = 0;
+  }
+  for (int n = 0; n < n_sum; n++){
     int center = random(500) + 774;
     int amp = random(500) + 3500;
     for (int i = 0; i < 2048; i++){
-      
-      unsigned int data = int(amp * pow(2.7,-(double(i-center)*(i-1024)/160000)) + random(200));      
-      Serial.write(byte(data>>8)); // high byte
-      Serial.write(byte(data)); // low byte      
+      sum[i] += int(amp * pow(2.7,-(double(i-center)*(i-1024)/160000)) + random(200));
     }
   }
-  delay(2);
 }
 
 void establishContact(){
-  Serial.println("Spec");
+  // Introduce the firmware and the detector: pixels, ADC bits, byte order,
+  // then the protocol features: F for framed spectra, S for streaming,
+  // B for a switchable baud rate or U for native USB, P and D for packed
+  // and delta coded pixels
+  LINK.println("Spec,2048,12,B," FEATURES);
 }
@@ -0,0 +1,2733 @@
+# -*- coding: utf-8 -*-
+
+# Author: Matthew Rowley
+# Date Created: February 11, 2015
+
+# The acquisition core of the spectrometer program: the arduino drivers, the
+# shared frame buffers, spectrum corrections, fitting and the file formats.
+# None of it needs Qt or a display, so it can be imported by scripts and the
+# Benchmarks, or run on its own to record spectra from the command line (see
+# main() at the end). Spectrometer_UI.py is the window built on top of it.
+
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+
+import numpy as np
+import sys
+import serial
+import time
+import os
+# scipy takes longer to import than everything else together, so it is only
+# imported by the fitting functions that need it, on first use
+import csv
+import queue
+import json
+import hashlib
+import tempfile
+import collections
+import struct
+import binascii
+import threading
+import argparse
+import urllib.parse
+
+
+# The core was built on QMutex, pyqtSignal and QThread before it was split
+# from the window. These stand-ins keep the same shape without Qt.
+class Mutex(object):
+    # lock() and unlock() as on a QMutex, for the shared state classes below
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+
+    def lock(self):
+        self.mutex.acquire()
+
+    def unlock(self):
+        self.mutex.release()
+
+
+# Declared on a class like a pyqtSignal. Each instance gets its own list of
+# slots, and emit() calls them in turn on the emitting thread, so a GUI has
+# to hand them on to its own thread (see Core_Relay in Spectrometer_UI.py).
+class Signal(object):
+
+    def __init__(self, *types):
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # The instance's own copy hides this descriptor from then on
+        slots = instance.__dict__[self.name] = Bound_Signal()
+        return slots
+
+
+class Bound_Signal(list):
+
+    def connect(self, slot):
+        self.append(slot)
+
+    def emit(self, *args):
+        for slot in self:
+            slot(*args)
+
+
+# Runs the calls posted to it one at a time, in order, as a QThread's event
+# loop runs queued slots. A call that raises is reported and skipped.
+class Worker_Thread(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.calls = queue.Queue()
+
+    def post(self, call):
+        self.calls.put(call)
+
+    # Stops once the calls already posted have run
+    def quit(self):
+        self.calls.put(None)
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            try:
+                call()
+            except Exception as e:
+                print(e)
+
+
+# Calls posted to a worker run on its own thread once startThread() has been
+# called, and straight away on the caller's thread before that
+class Worker(object):
+
+    def __init__(self):
+        self.thread = None
+
+    def startThread(self):
+        self.thread = Worker_Thread()
+        self.thread.start()
+
+    def stopThread(self):
+        if self.thread is not None:
+            self.thread.quit()
+            self.thread.join()
+            self.thread = None
+
+    def post(self, call):
+        if self.thread is None:
+            call()
+        else:
+            self.thread.post(call)
+
+
+# These mutex objects communicate between asynchronous arduino and gui threads
+class Spectrum(Mutex):
+    # A ring of preallocated frames, so the Spec_Duino can get ahead of the
+    # GUI by up to n_frames spectra before anything is overwritten. Each
+    # frame keeps its sequence number, timestamp and integration time. The
+    # lock is only held while copying, and reads never wait for new frames.
+
+    def __init__(self, n_frames=64, n_pixels=None):
+        Mutex.__init__(self)
+        if n_pixels is None:
+            n_pixels = DEFAULT_GEOMETRY[0]
+        self.n_frames = n_frames
+        self.frames = np.zeros((n_frames, n_pixels), float)
+        self.sequences = np.full(n_frames, -1, np.int64)
+        self.timestamps = np.zeros(n_frames, float)
+        self.i_times = np.zeros(n_frames, np.int64)
+        self.next_sequence = 0  # Sequence number of the next frame written
+        self.read_sequence = 0  # Oldest frame not yet read
+        self.dropped = 0  # Frames overwritten before they were read
+
+    def write(self, frame, i_time):
+        self.lock()
+        slot = self.next_sequence % self.n_frames
+        if self.next_sequence - self.read_sequence >= self.n_frames:
+            self.dropped += 1
+            self.read_sequence += 1
+        np.copyto(self.frames[slot], frame)
+        self.sequences[slot] = self.next_sequence
+        self.timestamps[slot] = time.time()
+        self.i_times[slot] = i_time
+        self.next_sequence += 1
+        self.unlock()
+
+    # Returns [frame, integration time, sequence, timestamp] of the newest
+    # frame, or None if nothing has been written yet
+    def readLatest(self):
+        self.lock()
+        if self.next_sequence == 0:
+            self.unlock()
+            return None
+        slot = (self.next_sequence - 1) % self.n_frames
+        latest = [self.frames[slot].copy(), int(self.i_times[slot]),
+                  int(self.sequences[slot]), float(self.timestamps[slot])]
+        self.unlock()
+        return latest
+
+    # Returns [frame, integration time, sequence, timestamp, skipped] for the
+    # newest frame if it hasn't been read yet, or None. Only that frame is
+    # copied, and the unread frames before it are passed over. skipped
+    # counts those still in the ring; the rest were dropped.
+    def readNewest(self):
+        self.lock()
+        start = self.read_sequence
+        if self.next_sequence <= start:
+            self.unlock()
+            return None
+        slot = (self.next_sequence - 1) % self.n_frames
+        newest = [self.frames[slot].copy(), int(self.i_times[slot]),
+                  int(self.sequences[slot]), float(self.timestamps[slot]),
+                  self.next_sequence - 1 - start]
+        self.read_sequence = self.next_sequence
+        self.unlock()
+        return newest
+
+    # Only called when a detector with a different pixel count connects
+    def resize(self, n_pixels):
+        self.lock()
+        if self.frames.shape[1] != n_pixels:
+            self.frames = np.zeros((self.n_frames, n_pixels), float)
+            self.read_sequence = self.next_sequence  # The old frames are gone
+        self.unlock()
+
+
+class Sensor_Data(Mutex):
+
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [0.0, 0.0, 0.0]  # temp, humidity, pressure
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class I_Time(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = 5
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Fit_Job(Mutex):
+    # Only the newest spectrum waiting to be fit is kept, so the fit worker
+    # skips any that went stale while it was busy
+    def __init__(self):
+        Mutex.__init__(self)
+        # [calibration, data, fit engine, sequence, peak thresholds]
+        self.value = None
+
+    def take(self):
+        self.lock()
+        value = self.value
+        self.value = None
+        self.unlock()
+        return value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Fit_Result(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        # fit values, fit curve, sequence, and every peak in multi-peak mode
+        self.value = [None, None, -1, None]
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Averaging(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        # averaging mode, spectra per average, whether to sum on the arduino
+        self.value = [AVERAGING_MODES[0], 1, False]
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Frame_Variance(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = None  # Per-pixel variance of the newest averaged spectrum
+
+    def read(self):
+        self.lock()
+        value = None if self.value is None else self.value.copy()
+        self.unlock()
+        return value
+
+    def write(self, new_value):
+        self.lock()
+        if new_value is None or self.value is None or \
+           self.value.shape != new_value.shape:
+            self.value = None if new_value is None else new_value.copy()
+        else:
+            np.copyto(self.value, new_value)
+        self.unlock()
+
+
+class Run_Flag(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = False
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Auto_Exposure(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [False, 0.7]  # Enabled, target fraction of full scale
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Sequence_Job(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [[], 0.0]  # Integration times, interval in seconds
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Sequence_Data(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [np.zeros((0, DEFAULT_GEOMETRY[0])),
+                      np.zeros(0, SPECTRUM_METADATA)]  # Spectra, metadata
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Com_Port(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = None
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Baud_Rate(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = None  # None picks the fastest rate that works
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Link_Speed(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        # Baud, bytes/s, spectra/s and frame encoding
+        self.value = [DEFAULT_BAUD, None, None, FRAME_ENCODINGS[0]]
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Detector_Geometry(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = list(DEFAULT_GEOMETRY)  # pixels, ADC bits, byte order
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Link_Status(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [0, 0, 0]  # CRC errors, bytes skipped, frames lost
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+class Port_Status(Mutex):
+    def __init__(self):
+        Mutex.__init__(self)
+        self.value = [False, False]  # Connection status of sensor, spec ports
+
+    def read(self):
+        return self.value
+
+    def write(self, new_value):
+        self.lock()
+        self.value = new_value
+        self.unlock()
+
+
+# These classes handle the communication between arduinos
+class Sensor_Duino(Worker):
+    updated = Signal()
+    connected = Signal()
+    port = None
+    valid_connection = False
+
+    def read(self):
+        if not self.valid_connection:  # Generate dummy data
+            data = np.random.uniform(0, 12, 3)
+        else:  # Get data from the Arduino
+            self.port.write('r')
+            raw_vals = self.port.readline()
+            data = np.fromstring(raw_vals, dtype=float, sep=',')
+        sensor_Data.write(data)
+        self.updated.emit()
+
+    def connectPort(self):
+        status = port_Status.read()
+        self.closePort()
+        try:
+            self.port = serial.Serial(port=sensor_Port.read(), baudrate=9600,
+                                      timeout=2)
+            print("Connecting to the Sensor_Duino on port " +
+                  str(sensor_Port.read()))
+            status[0] = True
+            self.valid_connection = True
+        except Exception as e:
+            print(e)
+            status[0] = False
+            self.valid_connection = False
+        port_Status.write(status)
+        self.connected.emit()
+
+    def closePort(self):
+        print("Closing Sensor port if open")
+        try:
+            self.port.close()
+        except Exception as e:
+            print(e)
+
+
+class Spec_Duino(Worker):
+    updated = Signal()
+    connected = Signal()
+    read_failed = Signal()
+    sequence_done = Signal()
+    exposure_changed = Signal(int)
+    port = None
+    valid_connection = False
+
+    def __init__(self):
+        Worker.__init__(self)
+        self.looping = False
+        self.features = ""  # Protocol features the firmware offered
+        self.encoding = 0  # The frame encoding asked of the firmware
+        self.reader = None
+        self.streaming = None  # The [i_time, n_sum] the arduino streams at
+        self.stream_i_time = None
+        self.sizeBuffers(list(DEFAULT_GEOMETRY))
+
+    # Every real spectrum is decoded into the same frame buffer, so buffers
+    # are only reallocated when a detector of a different size connects
+    def sizeBuffers(self, geometry):
+        n_pixels, bits, byte_order = geometry
+        self.geometry = geometry
+        pixel_bytes = 1 if bits <= 8 else 2 if bits <= 16 else 4
+        self.wire_dtype = np.dtype("{}u{}".format(byte_order, pixel_bytes))
+        self.frame_bytes = n_pixels * pixel_bytes
+        # Delta coding takes at most three bytes for each 16-bit pixel
+        self.max_payload = max(self.frame_bytes, 3 * n_pixels)
+        self.frame = np.zeros(n_pixels, float)
+        self.averager = Frame_Averager(n_pixels)
+        self.averaging = None  # The settings the averager was last reset with
+        self.exposure = Exposure_Controller(2**bits - 1)
+
+    # Acquire spectra back to back for as long as free_Run is set. Each step
+    # is posted to the back of this worker's queue, so port changes still get
+    # in. Free running needs the worker's thread (see startThread).
+    def freeRun(self):
+        if self.looping:  # A loop from an earlier toggle is still going
+            return
+        self.looping = True
+        self.freeRunStep()
+
+    def freeRunStep(self):
+        if not free_Run.read():
+            if self.streaming is not None:
+                self.stopStream()
+            self.looping = False
+            return
+        if self.valid_connection and "S" in self.features:
+            self.streamStep()
+        else:
+            self.read()
+        self.post(self.freeRunStep)
+
+    # Streaming firmware sends spectra back to back after one start command
+    # and takes new settings in-band, so the link never sits idle waiting
+    # for the next request. Each step takes every whole frame that has
+    # arrived, waiting for at least one.
+    def streamStep(self):
+        i_time = i_Time.read()
+        mode, count, on_device = self.checkAveraging()
+        n_sum = 1
+        if mode == AVERAGING_MODES[1] and on_device:
+            n_sum = min(count, MAX_DEVICE_SUM)
+        if self.streaming is None:
+            self.port.reset_input_buffer()
+            self.reader.clear()
+            self.port.write("S {} {} ".format(i_time, n_sum).encode())
+        elif [i_time, n_sum] != self.streaming:
+            self.port.write("I {} {} ".format(i_time, n_sum).encode())
+        self.streaming = [i_time, n_sum]
+        # The smallest a frame can be, with one byte per pixel
+        frame_size = FRAME_HEADER.size + len(self.frame) + FRAME_CRC.size
+        for index in range(spectrum.n_frames):
+            started = stage_Profiler.start()
+            frame = self.reader.readFrame(self.max_payload)
+            stage_Profiler.stop("Serial I/O", started)
+            if frame is None and self.reader.timed_out:
+                print("Spectrum stream stalled")
+                self.read_failed.emit()
+                self.streaming = None  # Start it again next step
+                break
+            if frame is not None and self.decodeFramed(frame):
+                self.addStreamed(self.frame, frame[1], mode, count, frame[2])
+            if len(self.reader.buffer) + self.port.in_waiting < frame_size:
+                break
+        link_Status.write([self.reader.crc_errors, self.reader.skipped_bytes,
+                           self.reader.lost_frames])
+
+    # Average streamed spectra the same way read() averages requested ones.
+    # Spectra are tagged with the integration time the arduino echoed, so
+    # those still in flight after a change are never mixed with new ones.
+    def addStreamed(self, data, i_time, mode, count, n_summed):
+        if i_time != self.stream_i_time:
+            self.stream_i_time = i_time
+            self.averager.reset()
+        if mode == AVERAGING_MODES[0] or n_summed > 1:
+            self.publish(data, i_time, None)
+        elif mode == AVERAGING_MODES[1]:
+            self.averager.add(data)
+            if self.averager.count >= count:
+                self.publish(self.averager.mean, i_time,
+                             self.averager.variance())
+                self.averager.reset()
+        else:
+            self.averager.add(data, 1.0 / count)
+            self.publish(self.averager.mean, i_time,
+                         self.averager.variance())
+
+    def stopStream(self):
+        self.streaming = None
+        self.stream_i_time = None
+        # The arduino finishes the spectrum it is on, then answers with an
+        # empty frame, after which nothing more is coming
+        try:
+            self.port.write(b"X ")
+            for index in range(spectrum.n_frames):
+                frame = self.reader.readFrame(self.max_payload)
+                if self.reader.timed_out or \
+                        (frame is not None and len(frame[4]) == 0):
+                    break
+            self.reader.clear()
+        except Exception as e:
+            print(e)
+
+    # Take every spectrum of a sequence here on the acquisition thread, so
+    # each starts on schedule rather than waiting on the GUI. Spectra start
+    # at fixed intervals from the first, and all of them are handed back as
+    # one dataset when the sequence ends or is stopped.
+    def runSequence(self):
+        i_times, interval = sequence_Job.read()
+        if self.streaming is not None:
+            self.stopStream()
+        spectra = np.zeros((len(i_times), len(self.frame)), float)
+        metadata = np.zeros(len(i_times), SPECTRUM_METADATA)
+        taken = 0
+        start = time.perf_counter()
+        for index, i_time in enumerate(i_times):
+            if not sequence_Run.read():
+                break
+            sleepUntil(start + index * interval)
+            started = time.time()
+            data = self.acquire(i_time, 1)
+            if data is None:
+                continue
+            spectra[taken] = data
+            sensors = sensor_Data.read()
+            metadata[taken] = (started, i_time, sensors[0], sensors[1],
+                               sensors[2], np.nan, np.nan)
+            taken += 1
+            self.publish(data, i_time, None)
+        sequence_Data.write([spectra[:taken], metadata[:taken]])
+        sequence_Run.write(False)
+        self.sequence_done.emit()
+
+    def checkAveraging(self):
+        settings = averaging.read()
+        if list(settings) != self.averaging:
+            self.averaging = list(settings)
+            self.averager.reset()
+        return settings
+
+    # Acquire one spectrum, averaging several raw spectra if asked to
+    def read(self):
+        i_time = i_Time.read()
+        mode, count, on_device = self.checkAveraging()
+        if mode == AVERAGING_MODES[0]:
+            data = self.acquire(i_time, 1)
+            variance = None
+        elif mode == AVERAGING_MODES[1] and on_device and \
+                self.valid_connection:
+            # The arduino sums the spectra, so there is no variance to report
+            data = self.acquire(i_time, min(count, MAX_DEVICE_SUM))
+            variance = None
+        elif mode == AVERAGING_MODES[1]:
+            self.averager.reset()
+            for index in range(count):
+                data = self.acquire(i_time, 1)
+                if data is None:
+                    break
+                self.averager.add(data)
+            if data is not None:
+                data = self.averager.mean
+                variance = self.averager.variance()
+        else:  # A running exponential average with a time constant of count
+            data = self.acquire(i_time, 1)
+            if data is not None:
+                self.averager.add(data, 1.0 / count)
+                data = self.averager.mean
+                variance = self.averager.variance()
+        if data is None:
+            return
+        self.publish(data, i_time, variance)
+
+    def publish(self, data, i_time, variance):
+        spectrum.write(data, i_time)
+        frame_Variance.write(variance)
+        spectrum_Recorder.push(data, i_time)
+        self.updated.emit()
+        enabled, target = auto_Exposure.read()
+        # Sequences set their own times, and spectra taken before the last
+        # change say nothing about the current one
+        if enabled and not sequence_Run.read() and i_time == i_Time.read():
+            new_i_time = self.exposure.update(data, i_time, target)
+            if new_i_time is not None:
+                i_Time.write(new_i_time)
+                self.exposure_changed.emit(new_i_time)
+
+    # Get one raw spectrum, or the average of n_sum spectra summed on the
+    # arduino, in the frame buffer. Returns None if the spectrum was lost.
+    def acquire(self, i_time, n_sum):
+        if not self.valid_connection:
+            # this generates a random gaussian dummy spectrum, as often as
+            # the spectrometer would send one
+            time.sleep(i_time * n_sum / 1000.)
+            n_pixels = len(self.frame)
+            amp = 3000. + np.random.random() * 1000
+            center = (875. + np.random.random() * 300) * n_pixels / 2048
+            fwhm = (300. + np.random.random() * 100) * n_pixels / 2048
+            offset = np.random.random() * 4
+            data = np.random.uniform(0, 100, n_pixels)
+            data = data + gaussian(np.arange(n_pixels), amp, center, fwhm,
+                                   offset)
+            np.copyto(self.frame, data)
+            return self.frame
+        if "F" in self.features:
+            return self.acquireFramed(i_time, n_sum)
+        # Get real data from the arduino
+        self.port.reset_input_buffer()  # Nothing stale can be waiting
+        self.port.write("{} {} ".format(i_time, n_sum).encode())
+        started = stage_Profiler.start()
+        stream = self.port.read(self.frame_bytes)
+        stage_Profiler.stop("Serial I/O", started)
+        if len(stream) != self.frame_bytes:  # The read timed out part way
+            print("Incomplete spectrum: {} of {} bytes received"
+                  .format(len(stream), self.frame_bytes))
+            self.port.reset_input_buffer()  # Drop any partial frame
+            self.read_failed.emit()
+            return None
+        started = stage_Profiler.start()
+        decodeFrame(stream, self.frame, self.wire_dtype)
+        if n_sum > 1:
+            self.frame /= n_sum
+        stage_Profiler.stop("Decode", started)
+        return self.frame
+
+    # Framed spectra carry a sequence number, the integration time and scan
+    # count actually used, and a CRC, so a corrupt spectrum is caught and
+    # the reader finds the start of the next one without reconnecting
+    def acquireFramed(self, i_time, n_sum):
+        self.port.reset_input_buffer()  # Nothing stale can be waiting
+        self.reader.clear()
+        self.port.write("{} {} ".format(i_time, n_sum).encode())
+        started = stage_Profiler.start()
+        frame = self.reader.readFrame(self.max_payload)
+        stage_Profiler.stop("Serial I/O", started)
+        link_Status.write([self.reader.crc_errors, self.reader.skipped_bytes,
+                           self.reader.lost_frames])
+        if frame is None or not self.decodeFramed(frame):
+            print("Spectrum lost: {} CRC errors, {} bytes skipped so far"
+                  .format(self.reader.crc_errors, self.reader.skipped_bytes))
+            self.read_failed.emit()
+            return None
+        return self.frame
+
+    # Decode a framed spectrum into the frame buffer, averaging it if it is
+    # a sum. Returns False if it doesn't fit the detector.
+    def decodeFramed(self, frame):
+        sequence, i_time, n_summed, encoding, payload = frame
+        started = stage_Profiler.start()
+        try:
+            decodePayload(payload, encoding, self.frame, self.wire_dtype)
+        except ValueError as e:
+            print(e)
+            return False
+        if n_summed > 1:
+            self.frame /= n_summed
+        stage_Profiler.stop("Decode", started)
+        return True
+
+    def connectPort(self):
+        status = port_Status.read()
+        self.closePort()
+        try:
+            self.port = openPort(spec_Port.read(), DEFAULT_BAUD, 2)
+            print("Connecting to the Spec_Duino on port " +
+                  str(spec_Port.read()))
+            response = self.port.readline().decode(errors="replace")
+            if len(response.strip()) == 0:
+                # A native USB port doesn't reset the arduino when opened,
+                # so the handshake was sent long ago. Ask for it again.
+                # Only when nothing came at all, as older firmware takes
+                # "H" for a request for a spectrum.
+                self.port.write(b"H ")
+                response = self.port.readline().decode(errors="replace")
+            geometry = parseHandshake(response)
+            if geometry is None:
+                print('Response on the Serial Port:{}'.format(response))
+                #raise ConnectionError("Spec Arduino may not be running proper "
+                #                      "firmware")
+                geometry = list(DEFAULT_GEOMETRY)
+            # Sometimes an errant extra "Spec" appears in the input buffer
+            self.port.readline()  # This clears "Spec" or waits 2s to timeout
+            # Anything else left over would put bare spectra out of step
+            self.port.reset_input_buffer()
+            self.features = parseFeatures(response)
+            self.streaming = None
+            self.reader = Frame_Reader(self.port)
+            # Use the most compact encoding the firmware offers. It still
+            # falls back to a plainer one for any spectrum that codes badly.
+            self.encoding = 0
+            if "D" in self.features:
+                self.encoding = 2
+            elif "P" in self.features:
+                self.encoding = 1
+            if self.encoding:
+                self.port.write("E {} ".format(self.encoding).encode())
+            if geometry != self.geometry:
+                print("Detector geometry: {} pixels, {} bits".format(
+                    geometry[0], geometry[1]))
+                self.sizeBuffers(geometry)
+                spectrum.resize(geometry[0])
+                detector_Geometry.write(geometry)
+            link_Speed.write(self.tuneLink(spec_Baud.read()) +
+                             [FRAME_ENCODINGS[self.encoding]])
+            self.reader = Frame_Reader(self.port)  # Forget probe errors
+            status[1] = True
+            self.valid_connection = True
+        except Exception as e:
+            print(e)
+            status[1] = False
+            self.valid_connection = False
+        port_Status.write(status)
+        self.connected.emit()
+
+    # Move the link to the fastest baud rate that carries spectra intact,
+    # or to the requested rate, and measure what it achieves. The arduino
+    # drops back to the last good rate unless a new rate is confirmed, so a
+    # rate that garbles the link costs a wait rather than the connection.
+    # Native USB ignores the baud rate, so it is only measured.
+    def tuneLink(self, baud):
+        if "F" not in self.features:  # Bare frames can't be checked
+            return [self.port.baudrate, None, None]
+        if "B" not in self.features:
+            link = "Native USB" if "U" in self.features else \
+                self.port.baudrate
+            return [link] + (self.probeLink() or [None, None])
+        rates = BAUD_RATES if baud is None else [baud]
+        best = [self.port.baudrate] + (self.probeLink() or [None, None])
+        for rate in rates:
+            if rate <= self.port.baudrate:
+                continue
+            self.port.write("B {} ".format(rate).encode())
+            self.port.flush()
+            time.sleep(0.05)  # Let the arduino switch over
+            self.port.baudrate = rate
+            self.port.reset_input_buffer()
+            self.reader.clear()
+            speed = self.probeLink()
+            if speed is None:
+                print("{} baud is unreliable, staying at {}"
+                      .format(rate, best[0]))
+                time.sleep(BAUD_CONFIRM_TIME)
+                self.port.baudrate = best[0]
+                self.port.reset_input_buffer()
+                self.reader.clear()
+                break
+            self.port.write(b"K ")
+            best = [rate] + speed
+        if best[1] is not None:
+            print("Spectrum link: {} baud, {:.0f} B/s, {:.1f} spectra/s"
+                  .format(*best))
+        return best
+
+    # Time a few spectra at the shortest integration time. Returns
+    # [bytes per second, spectra per second], or None if any were lost.
+    def probeLink(self, n_frames=3):
+        start = time.time()
+        n_bytes = 0
+        for index in range(n_frames):
+            self.port.write(b"1 1 ")
+            frame = self.reader.readFrame(self.max_payload)
+            if frame is None or not self.decodeFramed(frame):
+                return None
+            n_bytes += FRAME_HEADER.size + len(frame[4]) + FRAME_CRC.size
+        elapsed = max(time.time() - start, 1e-6)
+        return [n_bytes / elapsed, n_frames / elapsed]
+
+    def closePort(self):
+        print("Closing Spec port if open")
+        try:
+            self.port.close()
+        except Exception as e:
+            print(e)
+
+
+# Accumulates spectra in place, keeping a per-pixel mean and variance with
+# Welford's algorithm. add() with no weight averages every spectrum since the
+# last reset equally; with a weight it keeps an exponential running average.
+class Frame_Averager(object):
+
+    def __init__(self, n_pixels):
+        self.mean = np.zeros(n_pixels, float)
+        self.m2 = np.zeros(n_pixels, float)
+        self.delta = np.zeros(n_pixels, float)
+        self.scratch = np.zeros(n_pixels, float)
+        self.count = 0
+        self.weighted = False
+
+    def reset(self):
+        self.mean.fill(0.0)
+        self.m2.fill(0.0)
+        self.count = 0
+
+    def add(self, frame, weight=None):
+        self.count += 1
+        self.weighted = weight is not None
+        # Average equally until there are enough spectra for the weight
+        if weight is None or weight < 1.0 / self.count:
+            weight = 1.0 / self.count
+        np.subtract(frame, self.mean, out=self.delta)
+        np.multiply(self.delta, weight, out=self.scratch)
+        self.mean += self.scratch
+        if self.weighted:  # m2 holds the exponentially weighted variance
+            np.multiply(self.delta, self.scratch, out=self.scratch)
+            self.m2 += self.scratch
+            self.m2 *= 1.0 - weight
+        else:  # m2 holds the sum of squared differences from the mean
+            np.subtract(frame, self.mean, out=self.scratch)
+            self.scratch *= self.delta
+            self.m2 += self.scratch
+
+    def variance(self):
+        if self.weighted:
+            return self.m2
+        if self.count < 2:
+            return None
+        np.divide(self.m2, self.count - 1, out=self.scratch)
+        return self.scratch
+
+
+# Corrects raw spectra in place, stage by stage, on buffers allocated once
+# per detector. The raw spectrum is kept beside the corrected one, so a new
+# blank or flat field is applied by running again from the raw spectrum
+# rather than undoing the old one. The stages are:
+#   Dark: subtract the blank
+#   Nonlinearity: map counts through a polynomial, in np.polyval order, that
+#       makes the detector response linear
+#   Flat Field: divide by each pixel's relative responsivity
+#   Saturation: find pixels at full scale in the raw spectrum and set them
+#       to NaN in the corrected one, since their true value is unknown
+# Stages with nothing loaded are skipped. Every stage writes with out=, so
+# correcting a spectrum allocates nothing, and the time each stage last took
+# is kept in timings. The stages list may be reordered or trimmed.
+class Correction_Pipeline(object):
+    SATURATION = 0.98  # Raw counts above this fraction of full scale
+
+    def __init__(self, n_pixels, full_scale):
+        self.raw = np.zeros(n_pixels, float)
+        self.corrected = np.zeros(n_pixels, float)
+        self.scratch = np.zeros(n_pixels, float)
+        self.mask = np.zeros(n_pixels, bool)
+        self.full_scale = full_scale
+        self.dark = None
+        self.nonlinearity = None
+        self.inverse_flat = None
+        self.saturated = 0  # How many pixels the last spectrum had saturated
+        self.stages = [["Dark", self.subtractDark],
+                       ["Nonlinearity", self.linearize],
+                       ["Flat Field", self.flatten],
+                       ["Saturation", self.maskSaturated]]
+        self.timings = collections.OrderedDict(
+            (name, 0.0) for name, stage in self.stages)
+
+    def run(self, frame):
+        if frame is not self.raw:
+            np.copyto(self.raw, frame)
+        np.copyto(self.corrected, self.raw)
+        for name, stage in self.stages:
+            start = time.perf_counter()
+            stage()
+            self.timings[name] = time.perf_counter() - start
+        return self.corrected
+
+    def rerun(self):
+        return self.run(self.raw)
+
+    # Pixels with no response are left as they are
+    def setFlat(self, responsivity):
+        responsivity = np.asarray(responsivity, float)
+        responsive = responsivity > 0
+        self.inverse_flat = np.ones(len(responsivity))
+        np.divide(np.mean(responsivity[responsive]), responsivity,
+                  out=self.inverse_flat, where=responsive)
+
+    def subtractDark(self):
+        if self.dark is not None:
+            np.subtract(self.corrected, self.dark, out=self.corrected)
+
+    def linearize(self):  # Horner's rule, in the scratch buffer
+        if not self.nonlinearity:
+            return
+        self.scratch.fill(self.nonlinearity[0])
+        for coefficient in self.nonlinearity[1:]:
+            np.multiply(self.scratch, self.corrected, out=self.scratch)
+            np.add(self.scratch, coefficient, out=self.scratch)
+        np.copyto(self.corrected, self.scratch)
+
+    def flatten(self):
+        if self.inverse_flat is not None:
+            np.multiply(self.corrected, self.inverse_flat, out=self.corrected)
+
+    def maskSaturated(self):
+        np.greater_equal(self.raw, self.SATURATION * self.full_scale,
+                         out=self.mask)
+        self.saturated = int(np.count_nonzero(self.mask))
+        if self.saturated:
+            np.copyto(self.corrected, np.nan, where=self.mask)
+
+    # A copy of the corrected spectrum for fitting, with saturated pixels
+    # held at the tallest unsaturated value, like a clipped peak
+    def filled(self):
+        data = self.corrected.copy()
+        if self.saturated:
+            fill = 0.0
+            if self.saturated < len(data):
+                fill = np.max(data[~self.mask])
+            np.copyto(data, fill, where=self.mask)
+        return data
+
+
+# Steers the integration time so the tallest peak sits at a target fraction
+# of the ADC's full scale. Counts grow nearly in proportion to the
+# integration time, so scaling the time by target / peak lands close to the
+# target in one step, and the detector's fixed offset only costs a step or
+# two more. A saturated spectrum only says the time is too long, so it is
+# cut by SATURATED_STEP until the peak is back on scale.
+class Exposure_Controller(object):
+    SATURATION = 0.98  # Peaks above this fraction of full scale are clipped
+    SATURATED_STEP = 4.0
+    MAX_STEP = 16.0
+    DEADBAND = 0.1  # Leave the time alone within 10% of the target
+    LIMITS = [1, 10000]  # The range of the integration time box, in ms
+
+    def __init__(self, full_scale):
+        self.full_scale = full_scale
+
+    # Returns a new integration time, or None to keep this one
+    def update(self, frame, i_time, target):
+        peak = frame.max()
+        if peak >= self.SATURATION * self.full_scale:
+            ratio = 1 / self.SATURATED_STEP
+        else:
+            ratio = target * self.full_scale / max(peak, 1.0)
+            if abs(ratio - 1) < self.DEADBAND:
+                return None
+            ratio = min(max(ratio, 1 / self.MAX_STEP), self.MAX_STEP)
+        new_i_time = int(round(min(max(i_time * ratio, self.LIMITS[0]),
+                                   self.LIMITS[1])))
+        if new_i_time == i_time:
+            return None
+        return new_i_time
+
+
+# Streams every acquired spectrum to a binary spectrum file on its own
+# thread. Spec_Duino hands spectra over through a bounded queue and never
+# waits on it: if the disk falls far enough behind to fill the queue,
+# spectra are dropped and counted. Whatever has queued up is written as one
+# block, so a busy recorder catches up quickly.
+class Spectrum_Recorder(object):
+
+    def __init__(self, max_queued=256):
+        self.frames = queue.Queue(max_queued)
+        self.thread = None
+        self.recording = False
+        self.remaining = None  # Spectra still to take, if the count is fixed
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.save_path = None
+        self.calibration = None
+        self.blank = None
+
+    # Records until stopRecording(), or until max_frames have been queued
+    def startRecording(self, save_path, calibration, blank_data,
+                       max_frames=None):
+        self.save_path = save_path
+        self.calibration = calibration.copy()
+        self.blank = [blank_data[0].copy(), blank_data[1]]
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.remaining = max_frames
+        self.recording = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    # The thread finishes writing whatever is still queued, then stops
+    def stopRecording(self):
+        self.recording = False
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def push(self, frame, i_time):
+        if not self.recording:
+            return
+        try:
+            sensors = sensor_Data.read()
+            record = (time.time(), i_time, sensors[0], sensors[1],
+                      sensors[2], np.nan, np.nan)  # The fit is not known here
+            self.frames.put_nowait([record, frame.copy()])
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.recording = False
+
+    def run(self):
+        spc_file = None
+        try:
+            info = {"blank_i_time": int(self.blank[1])}
+            spc_file = createSpectrumFile(self.save_path, self.calibration,
+                                          self.blank[0], info=info)
+            while self.recording or not self.frames.empty():
+                try:
+                    batch = [self.frames.get(timeout=0.2)]
+                except queue.Empty:
+                    continue
+                while not self.frames.empty():
+                    batch.append(self.frames.get_nowait())
+                started = stage_Profiler.start()
+                spc_file.append(np.array([frame for record, frame in batch]),
+                                [record for record, frame in batch])
+                stage_Profiler.stop("Record", started)
+                self.written += len(batch)
+        except Exception as e:
+            self.error = str(e)
+            self.recording = False
+            print(e)
+        if spc_file is not None:
+            spc_file.close()
+        # Anything still queued after an error can't be written
+        while not self.frames.empty():
+            self.frames.get_nowait()
+            self.dropped += 1
+
+
+# Fits spectra on its own thread so the fit never holds up the GUI
+class Fit_Worker(Worker):
+    fitted = Signal()
+    previous = None  # The last fit values, used to warm start the next fit
+
+    def fit(self):
+        job = fit_Job.take()
+        if job is None:  # An earlier call already fit the newest spectrum
+            return
+        calibration, data, engine, sequence, thresholds = job
+        started = stage_Profiler.start()
+        peaks = None
+        if thresholds is None:
+            fit_vals = fitPeak(calibration, data, engine, self.previous)
+        else:
+            peaks = fitPeaks(calibration, data, engine, thresholds[0],
+                             thresholds[1])
+            fit_vals = None  # The tallest peak stands in for a single fit
+            if len(peaks) > 0:
+                fit_vals = list(peaks[np.argmax(peaks[:, 0])])
+        self.previous = fit_vals
+        fit_curve = None
+        if peaks is not None and len(peaks) > 0:
+            fit_curve = multiGaussian(calibration, peaks)
+        elif fit_vals is not None:
+            fit_curve = gaussian(calibration, fit_vals[0], fit_vals[1],
+                                 fit_vals[2], fit_vals[3])
+        stage_Profiler.stop("Fit", started)
+        fit_Result.write([fit_vals, fit_curve, sequence, peaks])
+        self.fitted.emit()
+
+
+# Reads calibration, flat field and spectrum .csv files on its own thread,
+# so a long file never holds up the window. What was read, or the error
+# reading it raised, is handed back with the kind of file and its path.
+# Binary spectrum files are memory mapped and quick to open, so they are
+# left for the window to open itself.
+class File_Loader(Worker):
+    loaded = Signal(str, str, object)
+
+    def load(self, kind, load_path):
+        try:
+            loaded = None
+            if load_path[-4:] != ".spc":
+                loaded = loadColumns(load_path)
+        except Exception as e:
+            loaded = e
+        self.loaded.emit(kind, load_path, loaded)
+
+
+# Times the phases of starting up. mark() ends a phase that ran since the
+# last mark, while begin() and end() time one that runs alongside others,
+# like a port connecting on its own thread. A phase that was never begun,
+# or has already ended, is not timed. Each phase is printed as it ends if
+# report is set; otherwise the times are only kept in phases.
+class Phase_Timer(object):
+
+    def __init__(self, started=None, report=False):
+        if started is None:
+            started = time.perf_counter()
+        self.started = started
+        self.last = started
+        self.report = report
+        self.pending = {}  # Start times of phases that have begun
+        self.phases = []  # [phase, seconds taken, seconds since started]
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.record(phase, now - self.last, now)
+        self.last = now
+
+    def begin(self, phase):
+        self.pending[phase] = time.perf_counter()
+
+    def end(self, phase):
+        if phase in self.pending:
+            now = time.perf_counter()
+            self.record(phase, now - self.pending.pop(phase), now)
+
+    def record(self, phase, seconds, now):
+        self.phases.append([phase, seconds, now - self.started])
+        if self.report:
+            print("Startup: {:<24} {:8.1f} ms  (at {:.1f} ms)"
+                  .format(phase, seconds * 1000,
+                          (now - self.started) * 1000))
+
+
+# Times each stage a spectrum goes through on its way to the screen, from
+# the worker threads and the window alike, so a sluggish free run can be
+# traced to the serial link, decoding, fitting or drawing. Each stage keeps
+# its last WINDOW times, for percentiles and a histogram, and counters add
+# up events like dropped spectra. A stage is timed with
+#   started = stage_Profiler.start()
+#   ...
+#   stage_Profiler.stop("Stage", started)
+# While disabled, start() returns None and stop() and count() return at
+# once, so the timers cost well under a microsecond when left in place.
+class Stage_Profiler(Mutex):
+    WINDOW = 512  # Times kept for each stage
+    # Histogram bins from 1 us to 10 s, five to a decade. Times outside
+    # them are counted in the first or last bin.
+    BINS = np.logspace(-6, 1, 36)
+    BARS = " ▁▂▃▄▅▆▇█"  # Histogram bars, from empty to the fullest bin
+
+    def __init__(self):
+        Mutex.__init__(self)
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.lock()
+        self.times = collections.OrderedDict()  # [ring of times, count]
+        self.counters = collections.OrderedDict()
+        self.since = time.time()
+        self.unlock()
+
+    def start(self):
+        if self.enabled:
+            return time.perf_counter()
+        return None
+
+    def stop(self, stage, started):
+        if started is not None:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage, seconds):
+        self.lock()
+        times = self.times.get(stage)
+        if times is None:
+            times = self.times[stage] = [np.zeros(self.WINDOW), 0]
+        times[0][times[1] % self.WINDOW] = seconds
+        times[1] += 1
+        self.unlock()
+
+    def count(self, counter, n=1):
+        if not self.enabled:
+            return
+        self.lock()
+        self.counters[counter] = self.counters.get(counter, 0) + n
+        self.unlock()
+
+    # Returns [stages, counters]. Each stage is [name, times recorded, mean,
+    # p50, p90, p99, max, histogram], in seconds over its window.
+    def summary(self):
+        self.lock()
+        windows = [[stage, times[0][:min(times[1], self.WINDOW)].copy(),
+                    times[1]] for stage, times in self.times.items()]
+        counters = list(self.counters.items())
+        self.unlock()
+        stages = []
+        for stage, window, count in windows:
+            p50, p90, p99 = np.percentile(window, [50, 90, 99])
+            histogram = np.histogram(np.clip(window, self.BINS[0],
+                                             self.BINS[-1]), self.BINS)[0]
+            stages.append([stage, count, window.mean(), p50, p90, p99,
+                           window.max(), histogram])
+        return stages, counters
+
+    # The summary as lines of text, with each histogram drawn in bars
+    def report(self):
+        stages, counters = self.summary()
+        lines = ["{:<14}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}   {:<18}{:>19}".format(
+            "Stage (ms)", "Count", "Mean", "p50", "p90", "p99", "Max",
+            "|1 us", "10 s|")]
+        for stage in stages:
+            histogram = stage[7]
+            bars = "".join(self.BARS[int(np.ceil(8 * n / histogram.max()))]
+                           for n in histogram)
+            lines.append("{:<14}{:>8}{:9.2f}{:9.2f}{:9.2f}{:9.2f}{:9.2f}   "
+                         "|{}|".format(stage[0], stage[1],
+                                       *[seconds * 1000
+                                         for seconds in stage[2:7]] +
+                                       [bars]))
+        if counters:
+            lines.append("   ".join("{}: {}".format(counter, n)
+                                    for counter, n in counters))
+        return lines
+
+    # Append the summary to a log file, tab separated, with the histogram
+    # counts in full
+    def export(self, log_path):
+        stages, counters = self.summary()
+        with open(log_path, "a") as log_file:
+            log_file.write("Profile from {} to {}\n".format(
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(self.since)),
+                time.strftime("%Y-%m-%d %H:%M:%S")))
+            # Each histogram column is headed by the start of its bin
+            log_file.write("Stage\tCount\tMean (ms)\tp50 (ms)\tp90 (ms)\t"
+                           "p99 (ms)\tMax (ms)\t" +
+                           "\t".join("{:.3g} s".format(edge)
+                                     for edge in self.BINS[:-1]) + "\n")
+            for stage in stages:
+                log_file.write("\t".join(
+                    [stage[0], str(stage[1])] +
+                    ["{:.4f}".format(seconds * 1000)
+                     for seconds in stage[2:7]] +
+                    [str(n) for n in stage[7]]) + "\n")
+            for counter, n in counters:
+                log_file.write("{}\t{}\n".format(counter, n))
+            log_file.write("\n")
+
+
+# Define a lambda function for use in fitting
+def gaussian(x, amp, center, fwhm, offset):
+    return amp * np.exp(-(x-center)**2/(2*fwhm**2)) + offset
+
+
+# Pixel count, ADC bits and byte order of the ILX511B, which is assumed
+# until a spectrometer reports its own in the handshake
+DEFAULT_GEOMETRY = [2048, 12, ">"]
+
+# The firmware always starts at DEFAULT_BAUD. Faster rates are tried in
+# order, and the arduino drops back to the last good rate unless a new one
+# is confirmed within BAUD_CONFIRM_TIME seconds.
+DEFAULT_BAUD = 115200
+BAUD_RATES = [115200, 230400, 460800, 921600, 2000000]
+BAUD_CONFIRM_TIME = 3.0
+
+# The averaging modes offered in the averaging combo box
+AVERAGING_MODES = ["No Averaging", "Average N Spectra", "Running Average"]
+# A 12 bit ADC can sum this many spectra without overflowing 16 bits
+MAX_DEVICE_SUM = 16
+
+# The sequences offered in the sequence combo box. A sweep steps through
+# 1, 2, 5, 10, 20, 50 ... ms up to the current integration time, and a
+# bracket takes these multiples of it.
+SEQUENCE_MODES = ["Timed Series", "Integration Sweep", "Auto Bracket"]
+BRACKET_FACTORS = [0.25, 0.5, 1, 2, 4]
+
+# The fit engines offered in the fit engine combo box
+FIT_ENGINES = ["Fast Estimate", "Refined Fit", "No Fit"]
+
+
+# A closed-form estimate of the gaussian parameters, taking well under a
+# millisecond rather than the several of a full curve_fit. The peak is
+# located in a lightly smoothed copy of the data, then a parabola is fit to
+# the log of the points above half maximum (Caruana's method, weighted by
+# the signal as suggested by Guo). If that parabola doesn't open downward,
+# moments of the same window are used instead. Returns [amp, center, fwhm,
+# offset] in the form gaussian() takes, or None if there is no peak to
+# speak of.
+def estimatePeak(x, y):
+    smooth = np.convolve(y, np.ones(9) / 9.0, mode='same')
+    offset = np.percentile(smooth, 5)
+    peak = np.argmax(smooth)
+    height = smooth[peak] - offset
+    if height <= 0:
+        return None
+    below = smooth < offset + height / 2.0
+    left = np.flatnonzero(below[:peak])
+    left = left[-1] + 1 if len(left) else 0
+    right = np.flatnonzero(below[peak:])
+    right = peak + right[0] if len(right) else len(y)
+    left, right = min(left, max(peak - 2, 0)), max(right, peak + 3)
+    x_window = x[left:right]
+    y_window = y[left:right] - offset
+    keep = y_window > 0
+    x_window, y_window = x_window[keep], y_window[keep]
+    if len(x_window) < 3:
+        return None
+    # Scale x to order one so the parabola fit is well conditioned
+    scale = x_window[-1] - x_window[0]
+    if scale == 0:
+        return None
+    u = (x_window - x[peak]) / scale
+    a, b, c = np.polyfit(u, np.log(y_window), 2, w=y_window)
+    if a < 0:
+        center = x[peak] - scale * b / (2 * a)
+        fwhm = scale * np.sqrt(-1 / (2 * a))
+        amp = np.exp(c - b**2 / (4 * a))
+    else:
+        total = np.sum(y_window)
+        center = np.sum(x_window * y_window) / total
+        fwhm = np.sqrt(np.sum(y_window * (x_window - center)**2) / total)
+        amp = height
+    return [amp, center, abs(fwhm), offset]
+
+
+# A least squares gaussian fit seeded from estimatePeak and restricted to
+# the points within three widths of the estimated center. If curve_fit
+# fails to converge the estimate is returned instead.
+def refinePeak(x, y, guesses):
+    from scipy.optimize import curve_fit as fit
+    window = np.abs(x - guesses[1]) < 3 * guesses[2]
+    if np.count_nonzero(window) < 5:
+        return guesses
+    try:
+        fit_vals, cov = fit(gaussian, x[window], y[window], p0=guesses)
+    except (RuntimeError, ValueError) as e:
+        print(e)
+        return guesses
+    fit_vals[2] = abs(fit_vals[2])
+    return list(fit_vals)
+
+
+# Fit a peak using one of the FIT_ENGINES, returning gaussian parameters or
+# None if no fit is wanted or possible. Consecutive spectra are usually
+# nearly identical, so the refined fit starts from the previous fit values
+# whenever the peak has moved by less than its width.
+def fitPeak(x, y, engine, previous=None):
+    if engine == "No Fit":
+        return None
+    guesses = estimatePeak(x, y)
+    if guesses is None or engine == "Fast Estimate":
+        return guesses
+    if previous is not None and abs(previous[1] - guesses[1]) < previous[2]:
+        guesses = previous
+    return refinePeak(x, y, guesses)
+
+
+# Find every peak standing at least prominence counts above its
+# surroundings and at least min_width pixels wide at half prominence, and
+# estimate each one with the log-parabola of estimatePeak. All the windows
+# are solved together: the weighted least squares sums for each window are
+# gathered with bincount and the 3x3 normal equations solved as one batch.
+# Returns an array with an [amp, center, fwhm, offset] row per peak, ordered
+# by center. The refined engine follows up with one joint curve_fit.
+def fitPeaks(x, y, engine, prominence, min_width):
+    no_peaks = np.zeros((0, 4))
+    if engine == "No Fit":
+        return no_peaks
+    from scipy.signal import find_peaks
+    smooth = np.convolve(y, np.ones(5) / 5.0, mode='same')
+    peaks, properties = find_peaks(smooth, prominence=prominence,
+                                   width=min_width, rel_height=0.5)
+    if len(peaks) == 0:
+        return no_peaks
+    n_peaks = len(peaks)
+    base = smooth[peaks] - properties["prominences"]
+    left = np.floor(properties["left_ips"]).astype(int)
+    right = np.ceil(properties["right_ips"]).astype(int) + 1
+    left = np.minimum(left, np.maximum(peaks - 1, 0))
+    right = np.maximum(right, np.minimum(peaks + 2, len(y)))
+    # Flatten every window into one long index array
+    counts = right - left
+    owner = np.repeat(np.arange(n_peaks), counts)
+    index = (np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts,
+                                                    counts) + left[owner])
+    scale = x[right - 1] - x[left]
+    scale[scale == 0] = 1.0
+    u = (x[index] - x[peaks][owner]) / scale[owner]
+    signal = y[index] - base[owner]
+    positive = signal > 0
+    weight = np.where(positive, signal, 0.0)**2
+    log_signal = np.log(np.where(positive, signal, 1.0))
+    s = [np.bincount(owner, weight * u**k, n_peaks) for k in range(5)]
+    t = [np.bincount(owner, weight * u**k * log_signal, n_peaks)
+         for k in range(3)]
+    normal = np.stack([np.stack([s[4], s[3], s[2]], -1),
+                       np.stack([s[3], s[2], s[1]], -1),
+                       np.stack([s[2], s[1], s[0]], -1)], -2)
+    rhs = np.stack([t[2], t[1], t[0]], -1)[..., np.newaxis]
+    # Fall back on the half maximum widths wherever a parabola won't do
+    pixels = np.arange(len(x))
+    center = x[peaks].astype(float)
+    fwhm = np.abs(np.interp(properties["right_ips"], pixels, x) -
+                  np.interp(properties["left_ips"], pixels, x)) / 2.3548
+    amp = properties["prominences"].astype(float)
+    solvable = np.abs(np.linalg.det(normal)) > 0
+    if np.any(solvable):
+        a, b, c = np.linalg.solve(normal[solvable], rhs[solvable])[..., 0].T
+        good = a < 0
+        fit_index = np.flatnonzero(solvable)[good]
+        a, b, c = a[good], b[good], c[good]
+        center[fit_index] += -scale[fit_index] * b / (2 * a)
+        fwhm[fit_index] = scale[fit_index] * np.sqrt(-1 / (2 * a))
+        amp[fit_index] = np.exp(c - b**2 / (4 * a))
+    estimates = np.stack([amp, center, fwhm, base], -1)
+    if engine == "Refined Fit":
+        estimates = refinePeaks(x, y, estimates)
+    return estimates[np.argsort(estimates[:, 1])]
+
+
+# A joint least squares fit of every peak, with one shared offset, over the
+# points within three widths of any peak. Falls back on the estimates if
+# curve_fit fails to converge.
+def refinePeaks(x, y, estimates):
+    from scipy.optimize import curve_fit as fit
+    window = np.any(np.abs(x - estimates[:, 1:2]) < 3 * estimates[:, 2:3],
+                    axis=0)
+    if np.count_nonzero(window) <= 3 * len(estimates) + 1:
+        return estimates
+    guesses = list(estimates[:, :3].ravel()) + [np.median(estimates[:, 3])]
+
+    def model(x, *params):
+        peaks = np.reshape(params[:-1], (-1, 3))
+        return multiGaussian(x, np.column_stack([peaks,
+                                                 np.zeros(len(peaks))]),
+                             params[-1])
+    try:
+        fit_vals, cov = fit(model, x[window], y[window], p0=guesses)
+    except (RuntimeError, ValueError) as e:
+        print(e)
+        return estimates
+    refined = np.empty_like(estimates)
+    refined[:, :3] = np.reshape(fit_vals[:-1], (-1, 3))
+    refined[:, 2] = np.abs(refined[:, 2])
+    refined[:, 3] = fit_vals[-1]
+    return refined
+
+
+# The sum of several gaussians, each given as an [amp, center, fwhm, offset]
+# row. Their offsets overlap, so the median of them is used unless an
+# offset is given.
+def multiGaussian(x, peaks, offset=None):
+    if offset is None:
+        offset = np.median(peaks[:, 3])
+    x = np.asarray(x)[np.newaxis, :]
+    return np.sum(peaks[:, 0:1] * np.exp(-(x - peaks[:, 1:2])**2 /
+                                        (2 * peaks[:, 2:3]**2)),
+                  axis=0) + offset
+
+
+# The arduino sends each pixel as a high byte then a low byte. Viewing the
+# stream as big-endian uint16 avoids a python loop over every pixel, and the
+# result is cast straight into the preallocated out array. A detector that
+# reports a different byte order or depth passes its own wire_dtype.
+def decodeFrame(stream, out, wire_dtype='>u2'):
+    np.copyto(out, np.frombuffer(stream, dtype=wire_dtype, count=len(out)))
+    return out
+
+
+# The pixel data encodings a framed spectrum can use, by the number in its
+# header. Packed pixels are 12 bits each, two to every three bytes. Delta
+# coded pixels are differences from the previous pixel, zigzag mapped so
+# small negative differences stay small, then written seven bits per byte,
+# least significant first, with the high bit set on all but the last byte.
+FRAME_ENCODINGS = ["Plain", "Packed 12-bit", "Delta"]
+
+
+# Decode framed pixel data into out, raising ValueError if it doesn't hold
+# exactly one value per pixel
+def decodePayload(stream, encoding, out, wire_dtype='>u2'):
+    if encoding == 0:
+        expected = len(out) * np.dtype(wire_dtype).itemsize
+    elif encoding == 1:
+        expected = 3 * ((len(out) + 1) // 2)
+    elif encoding == 2:
+        return decodeDelta(stream, out)
+    else:
+        raise ValueError("Unknown spectrum encoding {}".format(encoding))
+    if len(stream) != expected:
+        raise ValueError("{} encoded spectrum has {} bytes, expected {}"
+                         .format(FRAME_ENCODINGS[encoding], len(stream),
+                                 expected))
+    if encoding == 0:
+        return decodeFrame(stream, out, wire_dtype)
+    return unpack12(stream, out)
+
+
+def unpack12(stream, out):
+    packed = np.frombuffer(stream, np.uint8).reshape(-1, 3).astype(np.uint16)
+    out[0::2] = (packed[:, 0] << 4) | (packed[:, 1] >> 4)
+    out[1::2] = (((packed[:, 1] & 0x0F) << 8) | packed[:, 2])[:len(out) // 2]
+    return out
+
+
+def decodeDelta(stream, out):
+    codes = np.frombuffer(stream, np.uint8)
+    last = (codes & 0x80) == 0  # The final byte of each pixel
+    ends = np.flatnonzero(last)
+    if len(ends) != len(out) or not last[-1]:
+        raise ValueError("Delta encoded spectrum has {} pixels, expected {}"
+                         .format(len(ends), len(out)))
+    starts = np.zeros(len(ends), np.intp)
+    starts[1:] = ends[:-1] + 1
+    pixel = np.cumsum(last) - last
+    shifts = 7 * (np.arange(len(codes)) - starts[pixel])
+    values = np.add.reduceat((codes & 0x7F).astype(np.int64) << shifts,
+                             starts)
+    np.cumsum((values >> 1) ^ -(values & 1), out=values)
+    np.copyto(out, values)
+    return out
+
+
+# Code whole-number pixels the way the firmware's encodePixels does, for
+# the simulated spectrometer and the Benchmarks
+def encodePayload(values, encoding, wire_dtype='>u2'):
+    if encoding == 1:
+        return pack12(values)
+    if encoding == 2:
+        return deltaCode(values)
+    return np.asarray(values).astype(wire_dtype).tobytes()
+
+
+def pack12(values):
+    pairs = np.zeros(len(values) + len(values) % 2, int)
+    pairs[:len(values)] = values
+    pairs = pairs.reshape(-1, 2)
+    packed = np.empty((len(pairs), 3), np.uint8)
+    packed[:, 0] = pairs[:, 0] >> 4
+    packed[:, 1] = ((pairs[:, 0] & 0x0F) << 4) | (pairs[:, 1] >> 8)
+    packed[:, 2] = pairs[:, 1] & 0xFF
+    return packed.tobytes()
+
+
+# Each pixel takes as many bytes as its zigzagged difference needs, so the
+# bytes are laid out by repeating each difference once per byte it takes
+def deltaCode(values):
+    deltas = np.diff(np.asarray(values, np.int64), prepend=0)
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    n_bytes = 1 + sum((zigzag >> (7 * k) > 0).astype(np.int64)
+                      for k in range(1, 10))
+    pixel = np.repeat(np.arange(len(zigzag)), n_bytes)
+    place = np.arange(len(pixel)) - (np.cumsum(n_bytes) - n_bytes)[pixel]
+    codes = (zigzag[pixel] >> (7 * place)) & 0x7F
+    codes |= (place < n_bytes[pixel] - 1) << 7
+    return codes.astype(np.uint8).tobytes()
+
+
+# The firmware introduces itself with "Spec", optionally followed by the
+# detector geometry as ",<pixels>,<ADC bits>,<B or L for byte order>".
+# Returns [pixels, bits, byte order], with the default geometry for older
+# firmware that only says "Spec", or None if "Spec" never appears.
+def parseHandshake(response):
+    index = response.find("Spec")
+    if index < 0:
+        return None
+    fields = response[index:].strip().split(",")
+    try:
+        return [int(fields[1]), int(fields[2]),
+                "<" if fields[3].startswith("L") else ">"]
+    except (IndexError, ValueError):
+        return list(DEFAULT_GEOMETRY)
+
+
+# The baud combo box text as a rate, or None for Auto
+def baudSetting(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+# Firmware lists the protocol features it offers as letters after the
+# geometry: F for framed spectra, S for streaming, B for a switchable baud
+# rate, U for a native USB port, and P and D for packed and delta coded
+# spectra. Returns those letters.
+def parseFeatures(response):
+    fields = response[response.find("Spec"):].strip().split(",")
+    if len(fields) > 4:
+        return fields[4]
+    return ""
+
+
+# Each framed spectrum is a sync word, a header, the pixel data, then a
+# CRC-16 (CCITT polynomial 0x1021, starting at 0xFFFF) of the header and
+# data. All fields are big-endian. The header holds the sequence number,
+# the integration time used, the length of the pixel data in bytes, the
+# number of scans summed and the encoding of the pixel data (0 for plain).
+FRAME_SYNC = b"\xa5\x5aSP"
+FRAME_HEADER = struct.Struct(">4sHIIBB")
+FRAME_CRC = struct.Struct(">H")
+
+
+def buildFrame(sequence, i_time, n_sum, payload, encoding=0):
+    header = FRAME_HEADER.pack(FRAME_SYNC, sequence & 0xFFFF, i_time,
+                               len(payload), n_sum, encoding)
+    crc = binascii.crc_hqx(header[len(FRAME_SYNC):] + payload, 0xFFFF)
+    return header + payload + FRAME_CRC.pack(crc)
+
+
+# Pulls framed spectra out of a serial port, skipping anything that isn't
+# a whole, intact frame. Corrupt frames are counted and dropped, and the
+# search for the next sync word starts one byte past the bad one, so a lost
+# or garbled byte costs one spectrum rather than every spectrum after it.
+class Frame_Reader(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.buffer = bytearray()
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+        self.lost_frames = 0  # Sequence gaps not already counted as CRC errors
+        self.last_sequence = None
+        self.bad_since_good = 0  # CRC errors since the last intact frame
+        self.timed_out = False
+
+    def clear(self):
+        del self.buffer[:]
+
+    # Read until the buffer holds size bytes, or return False on a timeout
+    def fill(self, size):
+        while len(self.buffer) < size:
+            waiting = getattr(self.port, "in_waiting", 0)
+            chunk = self.port.read(max(size - len(self.buffer), waiting))
+            if len(chunk) == 0:
+                return False
+            self.buffer += chunk
+        return True
+
+    # Returns [sequence, i_time, n_sum, encoding, payload] for the next
+    # intact frame, or None if the port timed out or the frame was corrupt
+    def readFrame(self, max_length):
+        self.timed_out = False
+        while True:
+            if not self.fill(FRAME_HEADER.size):
+                self.timed_out = True
+                return None
+            index = self.buffer.find(FRAME_SYNC)
+            if index != 0:
+                if index < 0:  # Keep a possible partial sync word
+                    index = len(self.buffer) - len(FRAME_SYNC) + 1
+                self.skipped_bytes += index
+                del self.buffer[:index]
+                continue
+            sync, sequence, i_time, length, n_sum, encoding = \
+                FRAME_HEADER.unpack_from(self.buffer)
+            if length > max_length:  # Sync bytes that were really data
+                self.skipped_bytes += 1
+                del self.buffer[:1]
+                continue
+            end = FRAME_HEADER.size + length
+            if not self.fill(end + FRAME_CRC.size):
+                self.timed_out = True
+                return None
+            crc, = FRAME_CRC.unpack_from(self.buffer, end)
+            if binascii.crc_hqx(memoryview(self.buffer)[len(FRAME_SYNC):end],
+                                0xFFFF) != crc:
+                self.crc_errors += 1
+                self.bad_since_good += 1
+                self.skipped_bytes += 1
+                del self.buffer[:1]
+                return None
+            payload = bytes(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end + FRAME_CRC.size]
+            # A frame thrown out for its CRC leaves a gap too, but it has
+            # been counted already
+            if self.last_sequence is not None:
+                gap = (sequence - self.last_sequence - 1) & 0xFFFF
+                self.lost_frames += max(gap - self.bad_since_good, 0)
+            self.last_sequence = sequence
+            self.bad_since_good = 0
+            return [sequence, i_time, n_sum, encoding, payload]
+
+
+# Opens the spectrometer's port: a device name or any pyserial URL (see
+# serial.serial_for_url), or a simulated spectrometer for a SIMULATOR_URL
+def openPort(url, baudrate, timeout):
+    if url.startswith(SIMULATOR_URL):
+        return Simulated_Spec_Duino(url, baudrate, timeout)
+    return serial.serial_for_url(url, baudrate=baudrate, timeout=timeout)
+
+
+SIMULATOR_URL = "sim://"
+
+
+# Stands in for the serial port of a Spec_Duino, speaking the same protocol
+# as the firmware: the handshake, framed and bare spectra, streaming, baud
+# rate changes and encodings (see Hardware_Notes.md). Its options go in the
+# URL, e.g. "sim://?noise=5&peaks=4&drift=2&errors=1e-6&features=FSUPD":
+#   pixels, bits    detector geometry
+#   features        handshake features, "" for the oldest firmware
+#   rate            most spectra per second it can take, 0 for no limit
+#   time_scale      multiplies the integration time, 0 to skip the wait
+#   noise           read noise, in counts per scan
+#   peaks           number of gaussian peaks, placed at random
+#   drift           pixels per second the peaks drift by
+#   errors, drops   chance of each byte sent being garbled, or lost
+#   max_baud        fastest baud rate that carries bytes intact
+#   usb_rate        bytes per second of the native USB port
+#   seed            seeds the peaks and noise, for repeatable runs
+# Nothing runs in the background. Whatever the arduino would have done by
+# now is worked out whenever the port is used, with each spectrum arriving
+# once it has been integrated and sent at the current baud rate. At most
+# MAX_BUFFERED spectra wait unread, after which the arduino stalls as it
+# would on a full USB buffer.
+class Simulated_Spec_Duino(object):
+    OPTIONS = {"pixels": 2048, "bits": 12, "features": "FSBPD", "rate": 0.0,
+               "time_scale": 1.0, "noise": 10.0, "peaks": 3, "drift": 0.0,
+               "errors": 0.0, "drops": 0.0, "max_baud": 2000000,
+               "usb_rate": 1000000.0, "seed": None}
+    MAX_BUFFERED = 64
+    DARK_LEVEL = 100  # Counts with no light, plus DARK_RATE per ms
+    DARK_RATE = 0.2
+
+    def __init__(self, url, baudrate=DEFAULT_BAUD, timeout=None):
+        self.options = dict(self.OPTIONS)
+        query = urllib.parse.urlparse(url).query
+        for name, value in urllib.parse.parse_qsl(query, True):
+            if name not in self.options:
+                raise ValueError("Unknown simulator option " + name)
+            default = self.options[name]
+            self.options[name] = value if default is None or \
+                isinstance(default, str) else type(default)(value)
+        if self.options["seed"] is not None:
+            self.options["seed"] = int(self.options["seed"])
+        self.random = np.random.default_rng(self.options["seed"])
+        self.features = self.options["features"]
+        self.n_pixels = self.options["pixels"]
+        self.full_scale = 2**self.options["bits"] - 1
+        # The brightest peak nears full scale at about 50 ms
+        n_peaks = self.options["peaks"]
+        self.centers = self.random.uniform(0.15, 0.85, n_peaks) * \
+            self.n_pixels
+        self.widths = self.random.uniform(0.005, 0.03, n_peaks) * \
+            self.n_pixels
+        self.brightness = self.random.uniform(0.2, 1.0, n_peaks) * \
+            0.8 * self.full_scale / 50
+        self.pixels = np.arange(self.n_pixels)
+        bits = self.options["bits"]
+        pixel_bytes = 1 if bits <= 8 else 2 if bits <= 16 else 4
+        self.wire_dtype = ">u{}".format(pixel_bytes)
+        self.frame_bytes = self.n_pixels * pixel_bytes  # When plain
+        self.baudrate = baudrate  # The rate this end of the link is set to
+        self.timeout = timeout
+        self.baud = DEFAULT_BAUD  # The rate the arduino is set to
+        self.confirmed_baud = DEFAULT_BAUD
+        self.baud_changed = None
+        self.is_open = True
+        self.started = time.perf_counter()
+        self.busy_until = self.started  # When the arduino is next free
+        self.sending = collections.deque()  # [arrival time, bytes]
+        self.received = bytearray()  # Arrived, but not read yet
+        self.commands = b""
+        self.streaming = False
+        self.i_time = 100
+        self.n_sum = 1
+        self.encoding = 0
+        self.sequence = 0
+        self.handshake()
+
+    # The USB serial chip resets the arduino when the port opens, and it
+    # introduces itself twice, as the ILX511B firmware does
+    def handshake(self):
+        line = "Spec,{},{},B".format(self.n_pixels, self.options["bits"])
+        if self.features:
+            line += "," + self.features
+        self.send(2 * (line + "\r\n").encode())
+
+    @property
+    def in_waiting(self):
+        self.catchUp()
+        return len(self.received)
+
+    def read(self, size=1):
+        deadline = self.deadline()
+        self.catchUp()
+        while len(self.received) < size and self.waitUntil(deadline):
+            pass
+        data = bytes(self.received[:size])
+        del self.received[:size]
+        return data
+
+    def readline(self):
+        deadline = self.deadline()
+        self.catchUp()
+        while b"\n" not in self.received and self.waitUntil(deadline):
+            pass
+        end = self.received.find(b"\n") + 1 or len(self.received)
+        data = bytes(self.received[:end])
+        del self.received[:end]
+        return data
+
+    def write(self, data):
+        self.catchUp()
+        self.commands += bytes(data)
+        self.runCommands()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.catchUp()
+        del self.received[:]
+
+    def deadline(self):
+        if self.timeout is None:
+            return None
+        return time.perf_counter() + self.timeout
+
+    # Sleep until more bytes arrive or the deadline passes. Returns False
+    # once it has passed, or if nothing more is coming.
+    def waitUntil(self, deadline):
+        now = time.perf_counter()
+        if deadline is not None and now >= deadline:
+            return False
+        if self.sending:
+            wake = self.sending[0][0]
+        elif self.streaming:
+            wake = self.busy_until  # When the next spectrum starts
+        elif deadline is None:
+            return False
+        else:
+            wake = deadline
+        if deadline is not None:
+            wake = min(wake, deadline)
+        time.sleep(max(wake - now, 0))
+        self.catchUp()
+        return True
+
+    # Do whatever the arduino would have done by now
+    def catchUp(self):
+        now = time.perf_counter()
+        if self.baud_changed is not None and \
+                now - self.baud_changed > BAUD_CONFIRM_TIME:
+            self.baud = self.confirmed_baud  # Never confirmed
+            self.baud_changed = None
+        while self.streaming and self.busy_until <= now:
+            if len(self.received) + len(self.sending) * self.frame_bytes >= \
+                    self.MAX_BUFFERED * self.frame_bytes:
+                self.busy_until = now  # Stalled until the host reads
+                break
+            self.acquire(self.busy_until)
+        while self.sending and self.sending[0][0] <= now:
+            self.received += self.garble(self.sending.popleft()[1])
+
+    # Send bytes from start, by default once the arduino is free. They
+    # arrive once the last of them is through the link.
+    def send(self, data, start=None):
+        if start is None:
+            start = max(time.perf_counter(), self.busy_until)
+        if "U" in self.features:
+            arrival = start + len(data) / self.options["usb_rate"]
+        else:
+            arrival = start + len(data) * 10.0 / self.baud  # 10 bits a byte
+        self.sending.append([arrival, data])
+        self.busy_until = max(self.busy_until, arrival)
+
+    # Bytes sent at a rate this end isn't set to, or faster than the link
+    # carries, come through garbled
+    def garble(self, data):
+        errors = self.options["errors"]
+        if "U" not in self.features:
+            if self.baud != self.baudrate:
+                errors = 0.5
+            elif self.baud > self.options["max_baud"]:
+                errors = max(errors, 0.001)
+        data = np.frombuffer(data, np.uint8).copy()
+        if errors > 0:
+            hits = self.random.random(len(data)) < errors
+            data[hits] ^= self.random.integers(1, 256, np.count_nonzero(hits),
+                                               dtype=np.uint8)
+        if self.options["drops"] > 0:
+            data = data[self.random.random(len(data)) >= self.options["drops"]]
+        return data.tobytes()
+
+    # Commands are separated by spaces. The last one waits if its numbers
+    # haven't all arrived yet.
+    def runCommands(self):
+        text = self.commands.decode(errors="replace")
+        tokens = text.split()
+        partial = ""
+        if tokens and not text[-1].isspace():
+            partial = tokens.pop()
+        while tokens:
+            n_numbers = self.COMMANDS.get(tokens[0], 1)
+            if len(tokens) <= n_numbers:
+                break
+            command = tokens[:n_numbers + 1]
+            del tokens[:n_numbers + 1]
+            try:
+                self.runCommand(command)
+            except ValueError:  # The firmware's parseInt would read 0
+                pass
+        self.commands = " ".join(tokens + [partial]).lstrip().encode()
+
+    # The numbers each command letter takes. A bare request for a spectrum
+    # is its integration time and the number of scans to sum.
+    COMMANDS = {"S": 2, "I": 2, "B": 1, "E": 1, "X": 0, "K": 0, "H": 0}
+
+    def runCommand(self, command):
+        letter = command[0]
+        streams = "S" in self.features
+        if letter in "SIX" and not streams:
+            return
+        if letter == "B" and "B" in self.features:
+            self.baud = int(command[1])
+            self.baud_changed = time.perf_counter()
+        elif letter == "K":
+            self.confirmed_baud = self.baud
+            self.baud_changed = None
+        elif letter == "E":
+            self.encoding = int(command[1]) if int(command[1]) <= 2 else 0
+        elif letter == "H":
+            self.handshake()
+        elif letter == "X":
+            self.streaming = False
+            self.send(buildFrame(self.sequence, self.i_time, 0, b""))
+            self.sequence += 1
+        elif letter in "SI" or letter.isdigit():
+            numbers = command[1:] if letter in "SI" else command
+            self.i_time = int(numbers[0])
+            self.n_sum = min(max(int(numbers[1]), 1), MAX_DEVICE_SUM)
+            if letter == "S":
+                self.streaming = True
+                self.busy_until = max(self.busy_until, time.perf_counter())
+            elif letter != "I":
+                self.acquire(max(self.busy_until, time.perf_counter()))
+
+    # Integrate and send one spectrum, starting at started
+    def acquire(self, started):
+        integrating = self.i_time * self.n_sum * self.options["time_scale"]
+        if self.options["rate"] > 0:
+            integrating = max(integrating, 1000.0 / self.options["rate"])
+        counts = self.spectrum(started)
+        if "F" not in self.features:
+            payload = encodePayload(counts, 0, self.wire_dtype)
+        else:
+            payload = self.encodeFrame(counts)
+        self.send(payload, started + integrating / 1000)
+
+    # The counts the detector would read at time t, summed over n_sum scans
+    def spectrum(self, t):
+        drift = self.options["drift"] * (t - self.started)
+        centers = (self.centers + drift) % self.n_pixels
+        light = np.dot(self.brightness * self.i_time,
+                       np.exp(-0.5 * ((self.pixels - centers[:, None]) /
+                                      self.widths[:, None])**2))
+        scan = np.minimum(light + self.DARK_LEVEL +
+                          self.DARK_RATE * self.i_time, self.full_scale)
+        counts = self.n_sum * scan + self.options["noise"] * \
+            np.sqrt(self.n_sum) * self.random.standard_normal(self.n_pixels)
+        return np.clip(np.round(counts), 0,
+                       self.n_sum * self.full_scale).astype(np.int64)
+
+    # Frame the counts in the requested encoding, falling back to a plainer
+    # one when the firmware would
+    def encodeFrame(self, counts):
+        fallback = 1 if np.max(counts) <= 4095 else 0
+        used = 2 if self.encoding == 2 else min(self.encoding, fallback)
+        payload = encodePayload(counts, used, self.wire_dtype)
+        if used == 2 and len(payload) > self.frame_bytes * \
+                (0.75 if fallback else 1):
+            used = fallback
+            payload = encodePayload(counts, used, self.wire_dtype)
+        frame = buildFrame(self.sequence, self.i_time, self.n_sum, payload,
+                           used)
+        self.sequence += 1
+        return frame
+
+    def close(self):
+        self.is_open = False
+
+
+# The wavelengths shown before a calibration file is loaded
+def defaultCalibration(n_pixels):
+    return (3000 + 2 * np.arange(n_pixels)) / 8000000000.0
+
+
+# The integration time, in ms, of every spectrum in a sequence, with count
+# spectra at each integration time
+def sequencePlan(mode, i_time, count):
+    if mode == SEQUENCE_MODES[1]:
+        steps = []
+        decade = 1
+        while decade <= i_time:
+            steps += [step * decade for step in [1, 2, 5]
+                      if step * decade <= i_time]
+            decade *= 10
+    elif mode == SEQUENCE_MODES[2]:
+        # Times clamped to the same limit are only taken once
+        steps = sorted(set(min(max(int(round(i_time * factor)), 1), 10000)
+                           for factor in BRACKET_FACTORS))
+    else:
+        steps = [i_time]
+    return [step for step in steps for index in range(count)]
+
+
+# Sleep until a time.perf_counter() deadline, finishing with a short spin
+# because sleep alone can overshoot by a few ms
+def sleepUntil(deadline):
+    remaining = deadline - time.perf_counter()
+    if remaining > 0.002:
+        time.sleep(remaining - 0.002)
+    while time.perf_counter() < deadline:
+        pass
+
+
+# Binary spectrum files hold many spectra as one contiguous array, so they
+# can be appended to while recording and memory-mapped to read any single
+# spectrum without parsing the rest. A .spc file is a fixed size JSON header,
+# then the calibration and blank as float64, then the spectra. The metadata
+# table is a companion .spm file with one fixed size record per spectrum.
+# Counts come from the file sizes, so appending never rewrites the header.
+SPECTRUM_FILE_MAGIC = b"SPECTRUM"
+SPECTRUM_HEADER_SIZE = 4096
+SPECTRUM_METADATA = np.dtype([("time", "<f8"), ("i_time", "<f8"),
+                              ("temp", "<f4"), ("humidity", "<f4"),
+                              ("pressure", "<f4"), ("center", "<f8"),
+                              ("fwhm", "<f8")])
+
+
+class Spectrum_File(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.metadata_path = os.path.splitext(path)[0] + ".spm"
+        with open(path, "rb") as spc_file:
+            raw = spc_file.read(SPECTRUM_HEADER_SIZE)
+        if raw[:len(SPECTRUM_FILE_MAGIC)] != SPECTRUM_FILE_MAGIC:
+            raise ValueError("{} is not a binary spectrum file".format(path))
+        self.header = json.loads(raw[len(SPECTRUM_FILE_MAGIC):].decode())
+        self.n_pixels = self.header["n_pixels"]
+        self.dtype = np.dtype(self.header["dtype"])
+        self.data_offset = SPECTRUM_HEADER_SIZE + 2 * 8 * self.n_pixels
+        self.data_file = None
+        self.metadata_file = None
+
+    def count(self):
+        size = os.path.getsize(self.path) - self.data_offset
+        return size // (self.n_pixels * self.dtype.itemsize)
+
+    def calibration(self):
+        return np.memmap(self.path, "<f8", "r", SPECTRUM_HEADER_SIZE,
+                         (self.n_pixels,))
+
+    def blank(self):
+        return np.memmap(self.path, "<f8", "r",
+                         SPECTRUM_HEADER_SIZE + 8 * self.n_pixels,
+                         (self.n_pixels,))
+
+    # All the spectra as one read-only (count x n_pixels) memory map
+    def spectra(self):
+        count = self.count()
+        if count == 0:
+            return np.zeros((0, self.n_pixels), self.dtype)
+        return np.memmap(self.path, self.dtype, "r", self.data_offset,
+                         (count, self.n_pixels))
+
+    def spectrum(self, index):
+        return self.spectra()[index]
+
+    def metadata(self):
+        count = 0
+        if os.path.exists(self.metadata_path):
+            count = (os.path.getsize(self.metadata_path) //
+                     SPECTRUM_METADATA.itemsize)
+        if count == 0:
+            return np.zeros(0, SPECTRUM_METADATA)
+        return np.memmap(self.metadata_path, SPECTRUM_METADATA, "r", 0,
+                         (count,))
+
+    # Append one spectrum, or a (count x n_pixels) block of them, with a
+    # SPECTRUM_METADATA record for each. The files stay open until close().
+    def append(self, spectra, metadata):
+        if self.data_file is None:
+            self.data_file = open(self.path, "ab")
+            self.metadata_file = open(self.metadata_path, "ab")
+        spectra = np.asarray(spectra, self.dtype).reshape(-1, self.n_pixels)
+        metadata = np.asarray(metadata, SPECTRUM_METADATA).reshape(-1)
+        self.data_file.write(spectra.tobytes())
+        self.metadata_file.write(metadata.tobytes())
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.metadata_file.close()
+            self.data_file = None
+            self.metadata_file = None
+
+
+# Create an empty binary spectrum file. info holds anything else worth
+# keeping from a spectrum header, such as every peak of a multi-peak fit.
+def createSpectrumFile(path, calibration, blank, dtype="<f4", info=None):
+    header = {"version": 1, "n_pixels": len(calibration),
+              "dtype": np.dtype(dtype).str, "info": info or {}}
+    raw = SPECTRUM_FILE_MAGIC + json.dumps(header).encode()
+    if len(raw) > SPECTRUM_HEADER_SIZE:
+        raise ValueError("Spectrum file header is too long")
+    with open(path, "wb") as spc_file:
+        spc_file.write(raw.ljust(SPECTRUM_HEADER_SIZE, b" "))
+        spc_file.write(np.asarray(calibration, "<f8").tobytes())
+        spc_file.write(np.asarray(blank, "<f8").tobytes())
+    metadata_path = os.path.splitext(path)[0] + ".spm"
+    open(metadata_path, "wb").close()
+    return Spectrum_File(path)
+
+
+# The text header written above the columns of a spectrum .csv file
+def formatHeader(collected, i_time, temp, humidity, pressure, center, fwhm,
+                 peaks=None):
+    header = ("This spectrum was collected on:\t" +
+              time.strftime("%Y-%m-%d\t%H:%M:%S\n", time.localtime(collected)))
+    header += "Integration Time:\t{}\tms\n".format(i_time)
+    header += "------------------------\n"
+    header += "Environmental Parameters\n"
+    header += "------------------------\n"
+    header += "Temp:\t{0:.2f}\tdegrees C\n".format(temp)
+    header += "Humidity:\t{0:.2f}\t%\n".format(humidity)
+    header += "Pressure:\t{0:.2f}\tpa\n".format(pressure)
+    header += "--------------\n"
+    header += "Fit Parameters\n"
+    header += "--------------\n"
+    header += "Center:\t{0:.3e}\tm\n".format(center)
+    header += "FWHM:\t{0:.2e}\tm\n".format(fwhm)
+    if peaks is not None:
+        header += "Peaks Found:\t{}\n".format(len(peaks))
+        for index, peak in enumerate(peaks):
+            header += ("Peak {0}:\t{1:.3e}\tm\tFWHM:\t{2:.2e}\tm\n"
+                       .format(index + 1, peak[0], peak[1]))
+    header += "\n"
+    header += "Wavelength (m)\tCorrected Signal\tApplied Blank\n"
+    return header
+
+
+# A spectrum .csv file: the header from formatHeader, then a row of
+# wavelength, corrected signal and blank for each pixel
+def writeSpectrumCsv(save_path, header, calibration, data, blank):
+    with open(save_path, 'wt') as save_file:
+        save_file.write(header)
+        writer = csv.writer(save_file, dialect="excel-tab")
+        for rownum in range(len(calibration)):
+            row = [calibration[rownum], data[rownum], blank[rownum]]
+            writer.writerow(row)
+
+
+# Parsed spectrum and calibration files are cached by path, modification
+# time and size, both in memory and as .npz files in the Data folder beside
+# this file, so the files loaded at startup are not parsed again. Only the
+# most recently used files are kept: LOAD_CACHE_SIZE of them in memory and
+# LOAD_CACHE_FILES on disk.
+LOAD_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "Data", ".spec_cache")
+LOAD_CACHE_SIZE = 16
+LOAD_CACHE_FILES = 64
+load_cache = {}  # In the order they were used, the most recent last
+
+
+# Load the columns of a spectrum .csv or calibration .cal file, of any
+# length, with one vectorized np.loadtxt. The header fields above the
+# columns are returned keyed by their label, without the colon.
+def loadColumns(load_path):
+    load_path = os.path.abspath(load_path)
+    stats = os.stat(load_path)
+    key = [stats.st_mtime_ns, stats.st_size]
+    cached = load_cache.pop(load_path, None)
+    if cached is not None and cached[0] == key:
+        load_cache[load_path] = cached
+        return cached[1], cached[2]
+    cache_path = os.path.join(LOAD_CACHE_FOLDER, hashlib.sha1(
+        load_path.encode()).hexdigest() + ".npz")
+    try:
+        with np.load(cache_path) as cache_file:
+            if list(cache_file["key"]) == key:
+                fields = json.loads(str(cache_file["fields"]))
+                columns = cache_file["columns"]
+                rememberColumns(load_path, [key, fields, columns])
+                os.utime(cache_path)  # Used again, so pruned last
+                return fields, columns
+    except Exception:  # Not cached yet, or the cache file is unreadable
+        pass
+    fields, columns = parseColumns(load_path)
+    rememberColumns(load_path, [key, fields, columns])
+    try:
+        if not os.path.isdir(LOAD_CACHE_FOLDER):
+            os.makedirs(LOAD_CACHE_FOLDER)
+        np.savez(cache_path, key=np.array(key), columns=columns,
+                 fields=np.array(json.dumps(fields)))
+        pruneLoadCache()
+    except OSError as e:
+        print(e)
+    return fields, columns
+
+
+def rememberColumns(load_path, loaded):
+    load_cache[load_path] = loaded
+    while len(load_cache) > LOAD_CACHE_SIZE:
+        del load_cache[next(iter(load_cache))]
+
+
+# Delete all but the LOAD_CACHE_FILES most recently used .npz files, which
+# also clears out those of files that were moved, renamed or deleted
+def pruneLoadCache():
+    paths = [os.path.join(LOAD_CACHE_FOLDER, name)
+             for name in os.listdir(LOAD_CACHE_FOLDER)
+             if name.endswith(".npz")]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:-LOAD_CACHE_FILES]:
+        os.remove(path)
+
+
+def parseColumns(load_path):
+    fields = {}
+    header_length = 0
+    with open(load_path, "r") as load_file:
+        for line in load_file:
+            row = line.rstrip("\n").replace(",", "\t").split("\t")
+            if row[0] == "Wavelength (m)":  # The column titles of a spectrum
+                header_length += 1
+                break
+            try:
+                float(row[0])
+                break  # The first line of numbers
+            except ValueError:
+                pass
+            if row[0].endswith(":"):
+                fields[row[0][:-1]] = row[1:]
+            header_length += 1
+    delimiter = "," if "," in line else "\t"
+    columns = np.loadtxt(load_path, delimiter=delimiter,
+                         skiprows=header_length, ndmin=2)
+    columns.setflags(write=False)  # It is shared through the cache
+    return fields, columns
+
+
+# Convert a spectrum .csv file, old or new, into a binary spectrum file
+def importSpectrumCsv(csv_path, spc_path):
+    fields, columns = loadColumns(csv_path)
+    record = np.zeros(1, SPECTRUM_METADATA)
+    collected = fields.get("This spectrum was collected on")
+    if collected is not None:
+        record["time"] = time.mktime(time.strptime(" ".join(collected[:2]),
+                                                   "%Y-%m-%d %H:%M:%S"))
+    for name, label in [("i_time", "Integration Time"), ("temp", "Temp"),
+                        ("humidity", "Humidity"), ("pressure", "Pressure"),
+                        ("center", "Center"), ("fwhm", "FWHM")]:
+        if label in fields:
+            record[name] = float(fields[label][0])
+    labels = [label for label in fields if label.startswith("Peak ")]
+    # In number order, so "Peak 10" comes after "Peak 2"
+    peaks = [[float(fields[label][0]), float(fields[label][3])]
+             for label in sorted(labels, key=lambda l: int(l.split()[1]))]
+    blank = columns[:, 2] if columns.shape[1] > 2 else np.zeros(len(columns))
+    spc_file = createSpectrumFile(spc_path, columns[:, 0], blank,
+                                  info={"peaks": peaks} if peaks else None)
+    spc_file.append(columns[:, 1], record)
+    spc_file.close()
+    return spc_file
+
+
+# Write one spectrum of a binary spectrum file out in the .csv format
+def exportSpectrumCsv(spc_file, index, csv_path):
+    record = spc_file.metadata()[index]
+    peaks = spc_file.header["info"].get("peaks")
+    i_time = record["i_time"]
+    header = formatHeader(record["time"], int(i_time) if i_time.is_integer()
+                          else i_time, record["temp"], record["humidity"],
+                          record["pressure"], record["center"],
+                          record["fwhm"], peaks)
+    columns = np.column_stack([spc_file.calibration(),
+                               spc_file.spectrum(index), spc_file.blank()])
+    with open(csv_path, "wt") as save_file:
+        save_file.write(header)
+        np.savetxt(save_file, columns, fmt="%.10g", delimiter="\t")
+
+
+# The settings that carry over between sessions live in a small JSON file,
+# with the last blank in a .npy file beside it. Both are written to a
+# temporary file which then replaces the old one, so a crash part way
+# through a write leaves the previous settings intact. If neither exists
+# yet, the settings are read from an old line-by-line .spec.config file.
+class State_Store(object):
+
+    def __init__(self, settings_path=".spec.json",
+                 blank_path=".spec_blank.npy", legacy_path=".spec.config"):
+        self.settings_path = settings_path
+        self.blank_path = blank_path
+        self.legacy_path = legacy_path
+        self.settings = {}
+        self.blank = None
+        self.settings_changed = False
+        self.blank_changed = False
+
+    def load(self):
+        if os.path.exists(self.settings_path):
+            with open(self.settings_path, "r") as settings_file:
+                self.settings = json.load(settings_file)
+            if os.path.exists(self.blank_path):
+                self.blank = np.load(self.blank_path)
+        elif os.path.exists(self.legacy_path):
+            self.loadLegacy()
+        return self.settings, self.blank
+
+    def loadLegacy(self):
+        with open(self.legacy_path, "r") as config_file:
+            lines = config_file.read().splitlines()
+        self.settings = {"sensor_port": lines[1], "spec_port": lines[3],
+                         "calibration_file": lines[5],
+                         "spectrum_file": lines[7],
+                         "blank_i_time": int(lines[9])}
+        self.blank = np.array(lines[11:], float)
+        # Write the new files straight away, so this is only done once
+        self.settings_changed = True
+        self.blank_changed = True
+
+    def update(self, **settings):
+        self.settings.update(settings)
+        self.settings_changed = True
+
+    def setBlank(self, blank, i_time):
+        self.blank = np.array(blank, float)
+        self.settings["blank_i_time"] = int(i_time)
+        self.settings_changed = True
+        self.blank_changed = True
+
+    def save(self):
+        if self.blank_changed and self.blank is not None:
+            writeAtomically(self.blank_path, lambda save_file:
+                            np.save(save_file, self.blank))
+            self.blank_changed = False
+        if self.settings_changed:
+            writeAtomically(self.settings_path, lambda save_file:
+                            save_file.write(json.dumps(
+                                self.settings, indent=1).encode()))
+            self.settings_changed = False
+
+
+# Blanks kept on disk by integration time and sensor temperature, one .npy
+# file each, so a blank taken once serves every later session. Any
+# integration time can be looked up. Between two stored times the blank is
+# interpolated linearly, and outside them it is extrapolated from the
+# nearest two, as a dark frame is a fixed offset plus dark current growing
+# with time. A single stored time is used as it is. Answers are cached, so
+# a repeat lookup is one dict access. Stored blanks are only read when
+# needed, and the least recently used are dropped from memory.
+DARK_FOLDER = ".spec_darks"
+
+
+class Dark_Library(object):
+    TEMP_STEP = 2.0  # Width of the temperature bins, in degrees C
+
+    def __init__(self, folder=DARK_FOLDER, cache_size=32):
+        self.folder = folder
+        self.cache_size = cache_size
+        self.stored = {}  # (i_time, temperature bin): [path, time added]
+        self.loaded = collections.OrderedDict()  # Blanks read from disk
+        self.resolved = collections.OrderedDict()  # Answers to lookups
+        self.scan()
+
+    def scan(self):
+        self.stored = {}
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            try:
+                i_time, temp_bin = name[len("dark_"):-len(".npy")].split("_")
+                path = os.path.join(self.folder, name)
+                self.stored[(int(i_time), int(temp_bin))] = \
+                    [path, os.path.getmtime(path)]
+            except ValueError:  # Not one of ours
+                continue
+
+    def key(self, i_time, temp):
+        return (int(i_time), int(round(temp / self.TEMP_STEP)))
+
+    def add(self, blank, i_time, temp):
+        key = self.key(i_time, temp)
+        blank = np.array(blank, float)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = os.path.join(self.folder, "dark_{}_{}.npy".format(*key))
+        writeAtomically(path, lambda save_file: np.save(save_file, blank))
+        self.stored[key] = [path, time.time()]
+        self.remember(self.loaded, key, blank)
+        self.resolved.clear()  # Interpolated blanks may have changed
+
+    def clear(self):
+        self.loaded.clear()
+        self.resolved.clear()
+        for key in list(self.stored):
+            os.remove(self.stored.pop(key)[0])
+
+    # [blank, integration time] for i_time, or None if nothing is stored.
+    # The time is i_time for a blank stored or interpolated there, and the
+    # blank's own time when it is the only one there is. With temp, only
+    # blanks from the nearest temperature bin that has any are used.
+    # Otherwise the newest blank at each integration time is used.
+    def lookup(self, i_time, temp=None):
+        key = (int(i_time), None if temp is None else
+               self.key(i_time, temp)[1])
+        if key in self.resolved:
+            self.resolved.move_to_end(key)
+            return self.resolved[key]
+        blank = self.resolve(*key)
+        self.remember(self.resolved, key, blank)
+        return blank
+
+    def resolve(self, i_time, temp_bin):
+        candidates = {}  # i_time: key
+        if temp_bin is None:
+            for key in sorted(self.stored, key=lambda k: self.stored[k][1]):
+                candidates[key[0]] = key  # Newer blanks replace older ones
+        elif len(self.stored) > 0:
+            nearest = min(set(key[1] for key in self.stored),
+                          key=lambda bin: abs(bin - temp_bin))
+            candidates = {key[0]: key for key in self.stored
+                          if key[1] == nearest}
+        times = sorted(candidates)
+        if len(times) == 0:
+            return None
+        if i_time in candidates:
+            return [self.read(candidates[i_time]), i_time]
+        if len(times) == 1:
+            return [self.read(candidates[times[0]]), times[0]]
+        index = min(max(int(np.searchsorted(times, i_time)), 1),
+                    len(times) - 1)
+        low, high = times[index - 1], times[index]
+        low_blank = self.read(candidates[low])
+        high_blank = self.read(candidates[high])
+        if len(low_blank) != len(high_blank):  # From different detectors
+            nearest = low if i_time - low < high - i_time else high
+            return [self.read(candidates[nearest]), nearest]
+        blank = high_blank - low_blank
+        blank *= (i_time - low) / float(high - low)
+        blank += low_blank
+        return [np.maximum(blank, 0.0, out=blank), i_time]
+
+    def read(self, key):
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            return self.loaded[key]
+        blank = np.load(self.stored[key][0])
+        self.remember(self.loaded, key, blank)
+        return blank
+
+    def remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+
+# Write a file by handing write() a temporary file in the same folder, then
+# renaming it over path once it is safely on disk
+def writeAtomically(path, write):
+    folder = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_")
+    try:
+        with os.fdopen(handle, "wb") as save_file:
+            write(save_file)
+            save_file.flush()
+            os.fsync(save_file.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+# The shared state and workers, one of each. The window and the command line
+# both drive these.
+spectrum = Spectrum()
+sensor_Data = Sensor_Data()
+i_Time = I_Time()
+free_Run = Run_Flag()
+sequence_Run = Run_Flag()
+auto_Exposure = Auto_Exposure()
+sequence_Job = Sequence_Job()
+sequence_Data = Sequence_Data()
+fit_Job = Fit_Job()
+fit_Result = Fit_Result()
+averaging = Averaging()
+frame_Variance = Frame_Variance()
+spectrum_Recorder = Spectrum_Recorder()
+spec_Port = Com_Port()
+sensor_Port = Com_Port()
+spec_Baud = Baud_Rate()
+link_Speed = Link_Speed()
+port_Status = Port_Status()
+detector_Geometry = Detector_Geometry()
+link_Status = Link_Status()
+spec_Duino = Spec_Duino()
+sensor_Duino = Sensor_Duino()
+fit_Worker = Fit_Worker()
+file_Loader = File_Loader()
+stage_Profiler = Stage_Profiler()
+
+# Give up on a spectrometer that loses this many spectra in a row
+MAX_LOST_SPECTRA = 10
+
+
+# Record spectra to a binary spectrum file as fast as the spectrometer sends
+# them, without the window. For example:
+#   python3 Spectrometer_Core.py run.spc --port /dev/ttyACM0 --frames 1000
+#   python3 Spectrometer_Core.py run.spc --port COM3 --seconds 60 --i-time 20
+# Without a port, dummy spectra are recorded. Returns the exit status.
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Record spectra from the Spec_Duino without the window")
+    parser.add_argument("save_path", help="binary spectrum file to write")
+    parser.add_argument("--port", help="serial port or URL of the "
+                        "Spec_Duino, or sim://?options for a simulated one "
+                        "(dummy spectra are recorded without one)")
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument("--frames", type=int, default=100,
+                        help="spectra to record (default 100)")
+    length.add_argument("--seconds", type=float,
+                        help="record for this long instead")
+    parser.add_argument("--i-time", type=int, default=i_Time.read(),
+                        help="integration time in ms")
+    parser.add_argument("--average", type=int, default=1,
+                        help="spectra summed on the arduino into each one")
+    parser.add_argument("--baud", type=int,
+                        help="baud rate (default: the fastest that works)")
+    parser.add_argument("--calibration", help="calibration file to save "
+                        "with the spectra")
+    parser.add_argument("--profile", metavar="LOG", help="time each stage "
+                        "and print the times, and add them to this log file")
+    args = parser.parse_args(argv)
+    stage_Profiler.enabled = args.profile is not None
+    if not args.save_path.endswith(".spc"):
+        args.save_path += ".spc"
+    i_Time.write(args.i_time)
+    if args.average > 1:
+        averaging.write([AVERAGING_MODES[1], args.average, True])
+    if args.port is not None:
+        spec_Port.write(args.port)
+        spec_Baud.write(args.baud)
+        spec_Duino.connectPort()
+        if not port_Status.read()[1]:
+            print("Could not connect to the Spec_Duino on " + args.port)
+            return 1
+    n_pixels = detector_Geometry.read()[0]
+    calibration = defaultCalibration(n_pixels)
+    if args.calibration is not None:
+        fields, columns = loadColumns(args.calibration)
+        calibration = columns[:, 1]
+        if len(calibration) != n_pixels:
+            print("Calibration has {} pixels, not {}"
+                  .format(len(calibration), n_pixels))
+            return 1
+    lost = [0]  # Spectra lost since the last one that arrived
+
+    def lostSpectrum():
+        lost[0] += 1
+
+    def gotSpectrum():
+        lost[0] = 0
+    spec_Duino.read_failed.connect(lostSpectrum)
+    spec_Duino.updated.connect(gotSpectrum)
+    spectrum_Recorder.startRecording(args.save_path, calibration,
+                                     [np.zeros(n_pixels, float), 0],
+                                     None if args.seconds else args.frames)
+    start = time.perf_counter()
+    stop = start + args.seconds if args.seconds else None
+    stream = spec_Duino.valid_connection and "S" in spec_Duino.features
+    try:
+        while spectrum_Recorder.recording and lost[0] < MAX_LOST_SPECTRA:
+            if stop is not None and time.perf_counter() >= stop:
+                break
+            if stream:
+                spec_Duino.streamStep()
+            else:
+                spec_Duino.read()
+    except KeyboardInterrupt:  # Keep what has been recorded so far
+        pass
+    elapsed = time.perf_counter() - start
+    if spec_Duino.streaming is not None:
+        spec_Duino.stopStream()
+    spectrum_Recorder.stopRecording()
+    spectrum_Recorder.wait()
+    if args.port is not None:
+        spec_Duino.closePort()
+    crc_errors, skipped_bytes, lost_frames = link_Status.read()
+    print("{} spectra written to {} in {:.2f} s ({:.1f}/s), {} dropped, "
+          "{} link errors".format(spectrum_Recorder.written, args.save_path,
+                                  elapsed, spectrum_Recorder.written /
+                                  max(elapsed, 1e-6),
+                                  spectrum_Recorder.dropped,
+                                  crc_errors + lost_frames))
+    if args.profile is not None:
+        print("\n".join(stage_Profiler.report()))
+        try:
+            stage_Profiler.export(args.profile)
+        except OSError as e:
+            print(e)
+    if lost[0] >= MAX_LOST_SPECTRA:
+        print("Stopped after {} spectra were lost in a row".format(lost[0]))
+        return 1
+    if spectrum_Recorder.error is not None:
+        print("Recording error: " + spectrum_Recorder.error)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
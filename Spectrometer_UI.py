@@ -5,21 +5,37 @@
 
 # This program will gather and display spectra from a connected serial device.
 # It was written as part of research work at the University of Wisconsin -
-# Madison for use in the John C. Wright spectroscopy group.
+# Madison for use in the John C. Wright spectroscopy group. The window is
+# built on the acquisition core in Spectrometer_Core.py, which runs without
+# it.
 
 # This program is licenced under an MIT license. Full licence is at the end of
 # this file.
 
+import time
+# Taken before the other imports, so --startup-times can report them too
+STARTED = time.perf_counter()
 import numpy as np
 import sys
-import serial
-import time
 import os
-import serial.tools.list_ports
 from pyqtgraph import QtCore, QtGui
 import pyqtgraph as pg
-from scipy.optimize import curve_fit as fit
-import csv
+# The window uses most of the core, by the same names it always has
+from Spectrometer_Core import AVERAGING_MODES, BAUD_RATES, \
+    Correction_Pipeline, DEFAULT_GEOMETRY, Dark_Library, FIT_ENGINES, \
+    MAX_DEVICE_SUM, Phase_Timer, SEQUENCE_MODES, SIMULATOR_URL, \
+    SPECTRUM_METADATA, Spectrum_File, Stage_Profiler, State_Store, \
+    auto_Exposure, averaging, baudSetting, createSpectrumFile, \
+    defaultCalibration, detector_Geometry, file_Loader, fit_Job, fit_Result, \
+    fit_Worker, formatHeader, frame_Variance, free_Run, i_Time, link_Speed, \
+    link_Status, loadColumns, port_Status, sensor_Data, sensor_Duino, \
+    sensor_Port, sequencePlan, sequence_Data, sequence_Job, sequence_Run, \
+    spec_Baud, spec_Duino, spec_Port, spectrum, spectrum_Recorder, \
+    stage_Profiler, writeSpectrumCsv
+
+# Run with --startup-times to print how long each phase of startup takes
+startup = Phase_Timer(STARTED, "--startup-times" in sys.argv)
+startup.mark("Imports")
 
 
 class Main_Ui_Window(QtGui.QMainWindow):
@@ -33,29 +49,47 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.pressure = 0.0
         self.center = 0.0
         self.fwhm = 0.0
+        # [amp, center, fwhm, offset] rows in multi-peak mode
+        self.peaks = None
+        self.dropped_frames = 0
+        self.active_sequence = -1  # Sequence number of the displayed spectrum
+        self.frames_rendered = 0
+        self.rate_count = [0, 0, time.time()]  # acquired, rendered, when
         # Load config file and create global data objects
         # zero_data is [raw, integration time]
         # active_data is [calibration, corrected, integration time]
         # loaded_data is [calibration, corrected]
         # fit_data is [calibration, corrected]
-        self.blank_data = [np.zeros(2048, float), 0]
-        self.active_data = [np.array(range(3000, 9000, 2))[:2048]/8000000000.0,
-                            np.zeros(2048, float), 5.0]
-        self.loaded_data = [np.array(range(3000, 9000, 2))[:2048]/8000000000.0,
-                            np.zeros(2048, float)]
-        self.fit_data = [np.array(range(3000, 9000, 2))[:2048]/8000000000.0,
-                         np.zeros(2048, float)]
+        # Everything is sized for the default detector until a spectrometer
+        # reports a different geometry when it connects
+        n_pixels = DEFAULT_GEOMETRY[0]
+        self.blank_data = [np.zeros(n_pixels, float), 0]
+        # The corrected spectrum is the pipeline's own buffer, kept beside
+        # the raw spectrum it came from
+        self.pipeline = Correction_Pipeline(n_pixels,
+                                            2**DEFAULT_GEOMETRY[1] - 1)
+        self.active_data = [defaultCalibration(n_pixels),
+                            self.pipeline.corrected, 5.0]
+        self.loaded_data = [defaultCalibration(n_pixels),
+                            np.zeros(n_pixels, float)]
+        self.fit_data = [defaultCalibration(n_pixels),
+                         np.zeros(n_pixels, float)]
 
         # generate outbound signal and link all signals
-        spec_Duino.updated.connect(self.getData)
-        sensor_Duino.updated.connect(self.getSensorData)
-        spec_Duino.connected.connect(self.checkConnections)
-        sensor_Duino.connected.connect(self.checkConnections)
-        self.signal = Outbound_Signal()
-        self.signal.get_spectrum.connect(spec_Duino.read)
-        self.signal.get_sensors.connect(sensor_Duino.read)
-        self.signal.set_spec_port.connect(spec_Duino.connectPort)
-        self.signal.set_sensor_port.connect(sensor_Duino.connectPort)
+        # The workers signal from their own threads, so each signal is
+        # relayed to its slot here on the GUI thread
+        self.relays = [Core_Relay(spec_Duino.updated, self.getData, True),
+                       Core_Relay(sensor_Duino.updated, self.getSensorData),
+                       Core_Relay(spec_Duino.connected,
+                                  self.specConnected),
+                       Core_Relay(sensor_Duino.connected,
+                                  self.sensorConnected),
+                       Core_Relay(spec_Duino.read_failed, self.readFailed),
+                       Core_Relay(fit_Worker.fitted, self.showFit),
+                       Core_Relay(spec_Duino.sequence_done, self.sequenceDone),
+                       Core_Relay(spec_Duino.exposure_changed,
+                                  self.exposureChanged),
+                       Core_Relay(file_Loader.loaded, self.fileLoaded)]
 
         # Create the main UI window with a dark theme
         QtGui.QMainWindow.__init__(self, parent)
@@ -85,6 +119,40 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.i_time_box.setProperty("value", 5)
         self.i_time_box.setToolTip("Set Time to Integrate")
         self.parameters_layout.addWidget(self.i_time_box)
+        # Auto Exposure CheckBox, Label and Target SpinBox
+        self.auto_exposure_button = QtGui.QCheckBox(self.main_frame)
+        self.auto_exposure_button.setCheckable(True)
+        self.auto_exposure_button.setMaximumWidth(18)
+        self.auto_exposure_button.setToolTip("Adjust the Integration Time to "
+                                             "Keep the Tallest Peak Near the "
+                                             "Target")
+        self.parameters_layout.addWidget(self.auto_exposure_button)
+        self.auto_exposure_label = QtGui.QLabel(self.main_frame)
+        self.auto_exposure_label.setText("Auto Exposure")
+        self.auto_exposure_label.setToolTip("Adjust the Integration Time to "
+                                            "Keep the Tallest Peak Near the "
+                                            "Target")
+        self.parameters_layout.addWidget(self.auto_exposure_label)
+        self.exposure_target_box = QtGui.QSpinBox(self.main_frame)
+        self.exposure_target_box.setMaximum(95)
+        self.exposure_target_box.setMinimum(5)
+        self.exposure_target_box.setProperty("value", 70)
+        self.exposure_target_box.setSuffix(" %")
+        self.exposure_target_box.setToolTip("Target Height of the Tallest "
+                                            "Peak, as a Fraction of Full "
+                                            "Scale")
+        self.parameters_layout.addWidget(self.exposure_target_box)
+        # Plot Refresh Rate Label and SpinBox
+        self.plot_rate_label = QtGui.QLabel(self.main_frame)
+        self.plot_rate_label.setToolTip("Redraw Rate in Free Running Mode")
+        self.plot_rate_label.setText("Plot Rate (Hz):")
+        self.parameters_layout.addWidget(self.plot_rate_label)
+        self.plot_rate_box = QtGui.QSpinBox(self.main_frame)
+        self.plot_rate_box.setMaximum(60)
+        self.plot_rate_box.setMinimum(1)
+        self.plot_rate_box.setProperty("value", 30)
+        self.plot_rate_box.setToolTip("Redraw Rate in Free Running Mode")
+        self.parameters_layout.addWidget(self.plot_rate_box)
         # Load Calibration Curve Button
         self.load_cal_button = QtGui.QPushButton(self.main_frame)
         self.load_cal_button.setStyleSheet("background-color: "
@@ -94,6 +162,13 @@ class Main_Ui_Window(QtGui.QMainWindow):
                                         "Wavelengths to Pixel Numbers")
         self.load_cal_button.setText("Load Calibration Curve")
         self.parameters_layout.addWidget(self.load_cal_button)
+        self.load_flat_button = QtGui.QPushButton(self.main_frame)
+        self.load_flat_button.setStyleSheet("background-color: "
+                                            "rgb(150, 200, 175);\n")
+        self.load_flat_button.setToolTip("Load Each Pixel's Relative "
+                                         "Responsivity to Flatten Spectra")
+        self.load_flat_button.setText("Load Flat Field")
+        self.parameters_layout.addWidget(self.load_flat_button)
         # Messaging Area
         spacerItemL = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding,
                                         QtGui.QSizePolicy.Minimum)
@@ -124,8 +199,14 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.parameters_layout.addWidget(self.spec_port_label)
         self.spec_port_box = QtGui.QComboBox(self.main_frame)
         self.spec_port_box.setToolTip("Com Port for the Spectrometer Arduino")
-        self.findPorts()
         self.parameters_layout.addWidget(self.spec_port_box)
+        self.baud_box = QtGui.QComboBox(self.main_frame)
+        self.baud_box.setToolTip("Baud Rate for the Spectrometer Arduino. "
+                                 "Auto Uses the Fastest Rate That Works.")
+        self.baud_box.addItem("Auto")
+        for rate in BAUD_RATES:
+            self.baud_box.addItem(str(rate))
+        self.parameters_layout.addWidget(self.baud_box)
         self.vertical_layout.addLayout(self.parameters_layout)
         self.line_3 = QtGui.QFrame(self.main_frame)
         self.line_3.setFrameShape(QtGui.QFrame.HLine)
@@ -147,8 +228,20 @@ class Main_Ui_Window(QtGui.QMainWindow):
                                               "rgb(200, 180, 255);\n")
         self.clear_blank_button.setMaximumWidth(80)
         self.clear_blank_button.setText("Clear Blank")
-        self.clear_blank_button.setToolTip("Clear the Currently Stored Blank")
+        self.clear_blank_button.setToolTip("Clear Every Stored Blank")
         self.button_layout.addWidget(self.clear_blank_button)
+        self.dark_temp_button = QtGui.QCheckBox(self.main_frame)
+        self.dark_temp_button.setCheckable(True)
+        self.dark_temp_button.setMaximumWidth(18)
+        self.dark_temp_button.setToolTip("Use Blanks Taken Near the Current "
+                                         "Temperature")
+        self.button_layout.addWidget(self.dark_temp_button)
+        self.dark_temp_label = QtGui.QLabel(self.main_frame)
+        self.dark_temp_label.setText("Match Temp.")
+        self.dark_temp_label.setToolTip("Use Blanks Taken Near the Current "
+                                        "Temperature")
+        self.dark_temp_label.setMaximumWidth(80)
+        self.button_layout.addWidget(self.dark_temp_label)
         self.line_1 = QtGui.QFrame(self.main_frame)
         self.line_1.setFrameShape(QtGui.QFrame.VLine)
         self.line_1.setFrameShadow(QtGui.QFrame.Sunken)
@@ -175,6 +268,77 @@ class Main_Ui_Window(QtGui.QMainWindow):
                                            "as Possible")
         self.free_running_label.setMaximumWidth(115)
         self.button_layout.addWidget(self.free_running_label)
+        self.line_2 = QtGui.QFrame(self.main_frame)
+        self.line_2.setFrameShape(QtGui.QFrame.VLine)
+        self.line_2.setFrameShadow(QtGui.QFrame.Sunken)
+        self.button_layout.addWidget(self.line_2)
+        # Averaging ComboBox, Frame Count SpinBox and Sum on Device CheckBox
+        self.average_mode_box = QtGui.QComboBox(self.main_frame)
+        self.average_mode_box.addItems(AVERAGING_MODES)
+        self.average_mode_box.setToolTip("Average Several Spectra to Reduce "
+                                         "Noise")
+        self.button_layout.addWidget(self.average_mode_box)
+        self.average_count_box = QtGui.QSpinBox(self.main_frame)
+        self.average_count_box.setMaximum(1000)
+        self.average_count_box.setMinimum(1)
+        self.average_count_box.setProperty("value", 10)
+        self.average_count_box.setToolTip("Number of Spectra Averaged, or the "
+                                          "Time Constant of a Running "
+                                          "Average, in Spectra")
+        self.button_layout.addWidget(self.average_count_box)
+        self.device_sum_button = QtGui.QCheckBox(self.main_frame)
+        self.device_sum_button.setCheckable(True)
+        self.device_sum_button.setMaximumWidth(18)
+        self.device_sum_button.setToolTip("Sum up to {} Spectra on the "
+                                          "Arduino and Send Only the Sum"
+                                          .format(MAX_DEVICE_SUM))
+        self.button_layout.addWidget(self.device_sum_button)
+        self.device_sum_label = QtGui.QLabel(self.main_frame)
+        self.device_sum_label.setText("Sum on Device")
+        self.device_sum_label.setToolTip("Sum up to {} Spectra on the Arduino "
+                                         "and Send Only the Sum"
+                                         .format(MAX_DEVICE_SUM))
+        self.device_sum_label.setMaximumWidth(95)
+        self.button_layout.addWidget(self.device_sum_label)
+        self.line_12 = QtGui.QFrame(self.main_frame)
+        self.line_12.setFrameShape(QtGui.QFrame.VLine)
+        self.line_12.setFrameShadow(QtGui.QFrame.Sunken)
+        self.button_layout.addWidget(self.line_12)
+        # Sequence ComboBox, Frame Count and Interval SpinBoxes and Button
+        self.sequence_mode_box = QtGui.QComboBox(self.main_frame)
+        self.sequence_mode_box.addItems(SEQUENCE_MODES)
+        self.sequence_mode_box.setToolTip("Spectra at Fixed Intervals, a "
+                                          "Sweep of Integration Times Up to "
+                                          "the Current One, or a Bracket "
+                                          "Around the Current One")
+        self.button_layout.addWidget(self.sequence_mode_box)
+        self.sequence_count_box = QtGui.QSpinBox(self.main_frame)
+        self.sequence_count_box.setMaximum(100000)
+        self.sequence_count_box.setMinimum(1)
+        self.sequence_count_box.setProperty("value", 10)
+        self.sequence_count_box.setToolTip("Number of Spectra Taken at Each "
+                                           "Integration Time")
+        self.button_layout.addWidget(self.sequence_count_box)
+        self.sequence_interval_box = QtGui.QSpinBox(self.main_frame)
+        self.sequence_interval_box.setMaximum(3600000)
+        self.sequence_interval_box.setMinimum(0)
+        self.sequence_interval_box.setSuffix(" ms")
+        self.sequence_interval_box.setToolTip("Time From the Start of One "
+                                              "Spectrum to the Start of the "
+                                              "Next, 0 for As Fast as "
+                                              "Possible")
+        self.button_layout.addWidget(self.sequence_interval_box)
+        self.sequence_button = QtGui.QPushButton(self.main_frame)
+        self.sequence_button.setStyleSheet("QPushButton{background-color: "
+                                           "rgb(255, 180, 100);}\n"
+                                           "QPushButton:checked{background-"
+                                           "color: rgb(200, 110, 0);}")
+        self.sequence_button.setCheckable(True)
+        self.sequence_button.setMaximumWidth(200)
+        self.sequence_button.setToolTip("Acquire the Sequence and Save it as "
+                                        "One File")
+        self.sequence_button.setText("Run Sequence")
+        self.button_layout.addWidget(self.sequence_button)
         spacerItem1 = QtGui.QSpacerItem(400, 520, QtGui.QSizePolicy.Preferred,
                                         QtGui.QSizePolicy.Preferred)
         self.button_layout.addItem(spacerItem1)
@@ -191,6 +355,17 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.load_button.setToolTip("Load a Saved Spectrum")
         self.load_button.setText("Load Spectrum")
         self.button_layout.addWidget(self.load_button)
+        self.record_button = QtGui.QPushButton(self.main_frame)
+        self.record_button.setStyleSheet("QPushButton{background-color: "
+                                         "rgb(255, 90, 90);}\n"
+                                         "QPushButton:checked{background-"
+                                         "color: rgb(200, 0, 0);}")
+        self.record_button.setCheckable(True)
+        self.record_button.setMaximumWidth(200)
+        self.record_button.setToolTip("Stream Every Acquired Spectrum to a "
+                                      "File")
+        self.record_button.setText("Record")
+        self.button_layout.addWidget(self.record_button)
         self.vertical_layout.addLayout(self.button_layout)
         self.line = QtGui.QFrame(self.main_frame)
         self.line.setFrameShadow(QtGui.QFrame.Sunken)
@@ -205,6 +380,49 @@ class Main_Ui_Window(QtGui.QMainWindow):
         spacerItem2 = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding,
                                         QtGui.QSizePolicy.Minimum)
         self.fit_values_layout.addItem(spacerItem2)
+        self.fit_engine_label = QtGui.QLabel(self.main_frame)
+        self.fit_engine_label.setText("Fit:")
+        self.fit_engine_label.setToolTip("Method Used to Fit the Peak")
+        self.fit_values_layout.addWidget(self.fit_engine_label)
+        self.fit_engine_box = QtGui.QComboBox(self.main_frame)
+        self.fit_engine_box.addItems(FIT_ENGINES)
+        self.fit_engine_box.setToolTip("Fast Estimate is Closed-Form, Refined "
+                                       "Fit Adds a Least Squares Fit")
+        self.fit_values_layout.addWidget(self.fit_engine_box)
+        # Multi-Peak CheckBox, with a label for the same reason as above
+        self.multi_peak_button = QtGui.QCheckBox(self.main_frame)
+        self.multi_peak_button.setCheckable(True)
+        self.multi_peak_button.setMaximumWidth(18)
+        self.multi_peak_button.setToolTip("Find and Fit Every Peak Rather "
+                                          "Than Only the Tallest")
+        self.fit_values_layout.addWidget(self.multi_peak_button)
+        self.multi_peak_label = QtGui.QLabel(self.main_frame)
+        self.multi_peak_label.setText("Multi-Peak")
+        self.multi_peak_label.setToolTip("Find and Fit Every Peak Rather "
+                                         "Than Only the Tallest")
+        self.fit_values_layout.addWidget(self.multi_peak_label)
+        self.prominence_label = QtGui.QLabel(self.main_frame)
+        self.prominence_label.setText("Min. Prominence:")
+        self.prominence_label.setToolTip("Smallest Peak Height Above its "
+                                         "Surroundings, in Counts")
+        self.fit_values_layout.addWidget(self.prominence_label)
+        self.prominence_box = QtGui.QSpinBox(self.main_frame)
+        self.prominence_box.setMaximum(65535)
+        self.prominence_box.setMinimum(1)
+        self.prominence_box.setProperty("value", 200)
+        self.prominence_box.setToolTip("Smallest Peak Height Above its "
+                                       "Surroundings, in Counts")
+        self.fit_values_layout.addWidget(self.prominence_box)
+        self.peak_width_label = QtGui.QLabel(self.main_frame)
+        self.peak_width_label.setText("Min. Width:")
+        self.peak_width_label.setToolTip("Narrowest Peak FWHM, in Pixels")
+        self.fit_values_layout.addWidget(self.peak_width_label)
+        self.peak_width_box = QtGui.QSpinBox(self.main_frame)
+        self.peak_width_box.setMaximum(n_pixels)
+        self.peak_width_box.setMinimum(1)
+        self.peak_width_box.setProperty("value", 3)
+        self.peak_width_box.setToolTip("Narrowest Peak FWHM, in Pixels")
+        self.fit_values_layout.addWidget(self.peak_width_box)
         self.center_label = QtGui.QLabel(self.main_frame)
         self.center_label.setText("Center:  ")
         self.center_label.setToolTip("Center of Best Gaussian Fit")
@@ -242,6 +460,76 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.pressure_label.setToolTip("Current Ambient Pressure")
         self.fit_values_layout.addWidget(self.pressure_label)
         self.vertical_layout.addLayout(self.fit_values_layout)
+        self.peaks_label = QtGui.QLabel(self.main_frame)
+        self.peaks_label.setToolTip("Center and FWHM of Every Peak Found in "
+                                    "Multi-Peak Mode")
+        self.status_layout = QtGui.QHBoxLayout()
+        self.status_layout.addWidget(self.peaks_label)
+        spacerItem3 = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding,
+                                        QtGui.QSizePolicy.Minimum)
+        self.status_layout.addItem(spacerItem3)
+        self.line_8 = QtGui.QFrame(self.main_frame)
+        self.line_8.setFrameShape(QtGui.QFrame.VLine)
+        self.line_8.setFrameShadow(QtGui.QFrame.Sunken)
+        self.status_layout.addWidget(self.line_8)
+        self.rate_label = QtGui.QLabel(self.main_frame)
+        self.rate_label.setText("Acquired:  0  Rendered:  0")
+        self.rate_label.setToolTip("Spectra Acquired and Drawn, with Rates, "
+                                   "and Dropped Unread When the Window Fell "
+                                   "Behind")
+        self.status_layout.addWidget(self.rate_label)
+        self.line_10 = QtGui.QFrame(self.main_frame)
+        self.line_10.setFrameShape(QtGui.QFrame.VLine)
+        self.line_10.setFrameShadow(QtGui.QFrame.Sunken)
+        self.status_layout.addWidget(self.line_10)
+        self.noise_label = QtGui.QLabel(self.main_frame)
+        self.noise_label.setText("Noise:  --")
+        self.noise_label.setToolTip("Median Per-Pixel Standard Deviation of "
+                                    "the Averaged Spectra")
+        self.status_layout.addWidget(self.noise_label)
+        self.line_11 = QtGui.QFrame(self.main_frame)
+        self.line_11.setFrameShape(QtGui.QFrame.VLine)
+        self.line_11.setFrameShadow(QtGui.QFrame.Sunken)
+        self.status_layout.addWidget(self.line_11)
+        self.record_label = QtGui.QLabel(self.main_frame)
+        self.record_label.setText("Not Recording")
+        self.record_label.setToolTip("Spectra Written, Waiting to be "
+                                     "Written, and Dropped by the Recorder")
+        self.status_layout.addWidget(self.record_label)
+        self.line_12 = QtGui.QFrame(self.main_frame)
+        self.line_12.setFrameShape(QtGui.QFrame.VLine)
+        self.line_12.setFrameShadow(QtGui.QFrame.Sunken)
+        self.status_layout.addWidget(self.line_12)
+        # Profile CheckBox and Label, and a button to save the profile
+        self.profile_button = QtGui.QCheckBox(self.main_frame)
+        self.profile_button.setCheckable(True)
+        self.profile_button.setMaximumWidth(18)
+        self.profile_button.setToolTip("Time Each Stage of Acquiring and "
+                                       "Drawing Spectra")
+        self.status_layout.addWidget(self.profile_button)
+        self.profile_label = QtGui.QLabel(self.main_frame)
+        self.profile_label.setText("Profile")
+        self.profile_label.setToolTip("Time Each Stage of Acquiring and "
+                                      "Drawing Spectra")
+        self.status_layout.addWidget(self.profile_label)
+        self.save_profile_button = QtGui.QPushButton(self.main_frame)
+        self.save_profile_button.setMaximumWidth(120)
+        self.save_profile_button.setToolTip("Add the Stage Times to a Log "
+                                            "File")
+        self.save_profile_button.setText("Save Profile")
+        self.save_profile_button.setEnabled(False)
+        self.status_layout.addWidget(self.save_profile_button)
+        self.vertical_layout.addLayout(self.status_layout)
+        # The stage times, shown above the plot while profiling
+        self.profile_panel = QtGui.QLabel(self.main_frame)
+        font = QtGui.QFont("Monospace")
+        font.setStyleHint(QtGui.QFont.TypeWriter)
+        self.profile_panel.setFont(font)
+        self.profile_panel.setToolTip("Times of the Last {} Runs of Each "
+                                      "Stage, With a Histogram of Them"
+                                      .format(Stage_Profiler.WINDOW))
+        self.profile_panel.hide()
+        self.vertical_layout.addWidget(self.profile_panel)
         # The plot widget
         self.plot_object = pg.PlotWidget()
         self.plot_object.getPlotItem().setMouseEnabled(False, False)
@@ -276,52 +564,140 @@ class Main_Ui_Window(QtGui.QMainWindow):
         self.curser.sigPositionChanged.connect(self.curserMoved)
         self.i_time_box.valueChanged.connect(self.setIntegrationT)
         self.load_cal_button.clicked.connect(self.loadCalibration)
+        self.load_flat_button.clicked.connect(self.loadFlatField)
         self.sensor_port_box.currentIndexChanged.connect(self.selectSensorPort)
         self.spec_port_box.currentIndexChanged.connect(self.selectSpecPort)
+        self.baud_box.currentIndexChanged.connect(self.selectBaud)
         self.take_blank_button.clicked.connect(self.takeBlank)
         self.clear_blank_button.clicked.connect(self.clearBlank)
         self.take_snapshot_button.clicked.connect(self.takeSnapshot)
         self.free_running_button.toggled.connect(self.setFreeRunning)
+        self.plot_rate_box.valueChanged.connect(self.setPlotRate)
+        self.fit_engine_box.currentIndexChanged.connect(self.findFit)
+        self.multi_peak_button.toggled.connect(self.findFit)
+        self.prominence_box.valueChanged.connect(self.findFit)
+        self.peak_width_box.valueChanged.connect(self.findFit)
+        self.average_mode_box.currentIndexChanged.connect(self.setAveraging)
+        self.average_count_box.valueChanged.connect(self.setAveraging)
+        self.device_sum_button.toggled.connect(self.setAveraging)
         self.save_button.clicked.connect(self.saveCurve)
         self.load_button.clicked.connect(self.loadCurve)
+        self.record_button.toggled.connect(self.setRecording)
+        self.auto_exposure_button.toggled.connect(self.setAutoExposure)
+        self.dark_temp_button.toggled.connect(
+            lambda: self.matchBlank(self.i_time_box.value()))
+        self.exposure_target_box.valueChanged.connect(self.setAutoExposure)
+        self.sequence_button.toggled.connect(self.setSequence)
+        self.profile_button.toggled.connect(self.setProfiling)
+        self.save_profile_button.clicked.connect(self.saveProfile)
         # Start collecting sensor data and load the config
-        self.signal.get_sensors.emit()
+        self.state = State_Store()
+        self.darks = Dark_Library()
+        self.config_timer = QtCore.QTimer()
+        self.config_timer.setSingleShot(True)
+        self.config_timer.timeout.connect(self.saveConfig)
+        sensor_Duino.post(sensor_Duino.read)
         self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.signal.get_sensors.emit)
+        self.timer.timeout.connect(
+            lambda: sensor_Duino.post(sensor_Duino.read))
         self.timer.start(10000)  # update sensor data every 10s
-        self.loadConfig()
+        # In free running mode the plot is redrawn from the newest buffered
+        # spectrum on this timer, rather than once per acquired spectrum
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.timeout.connect(self.renderData)
+        self.record_timer = QtCore.QTimer()
+        self.record_timer.timeout.connect(self.updateRecording)
+        # The ports are listed and the settings loaded once the window is
+        # up, and the ports connect and the files load in the background
+        QtCore.QTimer.singleShot(0, self.finishStartup)
 
     # These methods are called as part of startup
+    def finishStartup(self):
+        startup.mark("Window shown")
+        self.findPorts()
+        startup.mark("Ports listed")
+        self.loadConfig()
+        startup.mark("Settings loaded")
+
     def loadConfig(self):  # Loads the previously used settings
         try:
-            with open(".spec.config", "r") as config_file:
-                lines = config_file.readlines()
-                # Set the port combo boxes and attempt to connect
-                self.sensor_port_box.setCurrentIndex(self.sensor_port_box.
-                                                     findText(lines[1][:-1]))
-                self.spec_port_box.setCurrentIndex(self.spec_port_box.
-                                                   findText(lines[3][:-1]))
-                self.importCalibration(lines[5][:-1])
-                self.importCurve(lines[7][:-1])
-                self.blank_data[1] = int(lines[9])
-                self.i_time_box.setValue(int(lines[9]))
-                self.setIntegrationT(verbose=False)
-                for index, value in enumerate(lines[11:]):
-                    self.blank_data[0][index] = float(value)
+            settings, blank = self.state.load()
+            # Set the baud rate and port combo boxes and attempt to connect
+            self.baud_box.blockSignals(True)  # Connect once, below
+            self.baud_box.setCurrentIndex(max(self.baud_box.findText(
+                settings.get("spec_baud", "Auto")), 0))
+            self.baud_box.blockSignals(False)
+            spec_Baud.write(baudSetting(self.baud_box.currentText()))
+            startup.begin("Sensor port connected")
+            startup.begin("Spectrum port connected")
+            self.sensor_port_box.setCurrentIndex(self.sensor_port_box.findText(
+                settings.get("sensor_port", "")))
+            self.spec_port_box.setCurrentIndex(self.spec_port_box.findText(
+                settings.get("spec_port", "")))
+            if settings.get("calibration_file"):
+                self.loadLater("Calibration", settings["calibration_file"])
+            if settings.get("flat_field_file"):
+                self.loadLater("Flat Field", settings["flat_field_file"])
+            # Nonlinearity coefficients are set by hand in .spec.json, as
+            # a list in np.polyval order that maps dark-subtracted counts to
+            # linear counts
+            self.pipeline.nonlinearity = settings.get("nonlinearity")
+            if settings.get("spectrum_file"):
+                self.loadLater("Spectrum", settings["spectrum_file"])
+            self.blank_data[1] = settings.get("blank_i_time", 0)
+            self.i_time_box.setValue(self.blank_data[1])
+            self.setIntegrationT(verbose=False)
+            if blank is not None and len(blank) == len(self.blank_data[0]):
+                self.blank_data[0] = blank
+                self.pipeline.dark = blank
+                # Blanks saved before the library existed join it
+                if self.blank_data[1] != 0 and \
+                        len(self.darks.stored) == 0:
+                    self.darks.add(blank, self.blank_data[1], self.temp)
+            if self.state.settings_changed:  # Settings moved from .spec.config
+                self.config_timer.start(500)
         except OSError as e:
-            self.updateMessage("**Filename Error - spec.config File Not "
+            self.updateMessage("**Filename Error - Saved Settings Not "
                                "Properly Imported**\n" + str(e)[:60])
             print(e)
         except Exception as e:
-            self.updateMessage("**Unknown Error - spec.config File Not "
+            self.updateMessage("**Unknown Error - Saved Settings Not "
                                "Properly Imported**\n" + str(e)[:60])
             print(e)
 
+    # Read a file on the file loader's thread, then import it in fileLoaded
+    def loadLater(self, kind, load_path):
+        startup.begin(kind + " loaded")
+        file_Loader.post(lambda: file_Loader.load(kind, load_path))
+
+    def fileLoaded(self, kind, load_path, loaded):
+        imports = {"Calibration": self.importCalibration,
+                   "Flat Field": self.importFlatField,
+                   "Spectrum": self.importCurve}
+        imports[kind](load_path, loaded=loaded)
+        startup.end(kind + " loaded")
+
+    def specConnected(self):
+        startup.end("Spectrum port connected")
+        self.checkConnections()
+
+    def sensorConnected(self):
+        startup.end("Sensor port connected")
+        self.checkConnections()
+
     def findPorts(self):
+        import serial.tools.list_ports  # Only needed here, at startup
         self.ports = serial.tools.list_ports.comports()
+        # loadConfig picks the ports to connect to
+        self.sensor_port_box.blockSignals(True)
+        self.spec_port_box.blockSignals(True)
         for index, comport in enumerate(self.ports[::-1]):
             self.sensor_port_box.addItem(comport[0])
             self.spec_port_box.addItem(comport[0])
+        # A simulated spectrometer, for trying things out without one
+        self.spec_port_box.addItem(SIMULATOR_URL)
+        self.sensor_port_box.blockSignals(False)
+        self.spec_port_box.blockSignals(False)
         if len(self.ports) == 0:
             self.updateMessage("**No Available Com Ports Detected**")
 
@@ -329,12 +705,17 @@ class Main_Ui_Window(QtGui.QMainWindow):
     def closeEvent(self, evt):
         if self.free_running:
             self.free_running_button.setChecked(False)
+        sequence_Run.write(False)
+        if self.record_button.isChecked():
+            self.record_button.setChecked(False)
+        spectrum_Recorder.wait()
+        if self.config_timer.isActive():  # Don't lose a pending save
+            self.config_timer.stop()
+            self.saveConfig()
         spec_Duino.closePort()
         sensor_Duino.closePort()
-        spec_thread.quit()
-        sensor_thread.quit()
-        while(not spec_thread.isFinished() or not sensor_thread.isFinished()):
-            time.sleep(1)
+        for worker in [spec_Duino, sensor_Duino, fit_Worker, file_Loader]:
+            worker.stopThread()
         QtGui.QMainWindow.closeEvent(self, evt)
 
     # These methods are for interacting with the graph
@@ -361,6 +742,7 @@ class Main_Ui_Window(QtGui.QMainWindow):
     # Button press methods
     def setIntegrationT(self, verbose=True):
         i_Time.write(self.i_time_box.value())
+        self.matchBlank(self.i_time_box.value())
         message = self.message_label.text()
         if verbose:
             message = ("Integration time set to {} ms - {}"
@@ -373,6 +755,34 @@ class Main_Ui_Window(QtGui.QMainWindow):
                        "Blank*".format(self.blank_data[1]))
         self.updateMessage(message)
 
+    def setAutoExposure(self):
+        auto_Exposure.write([self.auto_exposure_button.isChecked(),
+                             self.exposure_target_box.value() / 100.])
+        self.i_time_box.setEnabled(not self.auto_exposure_button.isChecked())
+
+    # A signal says auto exposure picked a new integration time
+    def exposureChanged(self, i_time):
+        self.i_time_box.blockSignals(True)  # i_Time is already up to date
+        self.i_time_box.setValue(i_time)
+        self.i_time_box.blockSignals(False)
+        self.matchBlank(i_time)
+        self.updateMessage("Auto Exposure Set the Integration Time to {} ms "
+                           "- {}".format(i_time,
+                                         time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    # Switch to the stored blank for i_time, interpolated between stored
+    # integration times if need be. The library caches its answers, so this
+    # is cheap enough to call for every spectrum drawn.
+    def matchBlank(self, i_time):
+        temp = self.temp if self.dark_temp_button.isChecked() else None
+        match = self.darks.lookup(i_time, temp)
+        if match is None or match[0] is self.blank_data[0] or \
+                len(match[0]) != len(self.blank_data[0]):
+            return
+        self.blank_data = list(match)
+        self.pipeline.dark = match[0]
+        self.pipeline.rerun()
+
     def loadCalibration(self):
         was_free_running = False
         if(self.free_running):
@@ -392,12 +802,24 @@ class Main_Ui_Window(QtGui.QMainWindow):
         if was_free_running:
             self.free_running_button.setChecked(True)
 
+    def loadFlatField(self):
+        load_path = (QtGui.QFileDialog.getOpenFileName(
+                     self, "Select a Flat Field File", "",
+                     "Flat Field Files (*.cal *.csv);;All Files (*.*)"))
+        if len(load_path) == 0:
+            self.updateMessage("**Flat Field Loading Cancelled - {}**"
+                               .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+            return
+        self.importFlatField(load_path)
+        self.state.update(flat_field_file=str(load_path))
+        self.config_timer.start(500)
+
     def selectSensorPort(self):
         spec_index = self.spec_port_box.currentIndex()
         sensor_index = self.sensor_port_box.currentIndex()
         if sensor_index != spec_index:
             sensor_Port.write(self.sensor_port_box.currentText())
-            self.signal.set_sensor_port.emit()
+            sensor_Duino.post(sensor_Duino.connectPort)
         else:
             self.updateMessage("**Please Select Different Com Ports for "
                                "Sensor and Spectrometer**")
@@ -407,17 +829,38 @@ class Main_Ui_Window(QtGui.QMainWindow):
         sensor_index = self.sensor_port_box.currentIndex()
         if sensor_index != spec_index:
             spec_Port.write(self.spec_port_box.currentText())
-            self.signal.set_spec_port.emit()
+            spec_Duino.post(spec_Duino.connectPort)
         else:
             self.updateMessage("**Please Select Different Com Ports for "
                                "Sensor and Spectrometer**")
 
+    def selectBaud(self):
+        spec_Baud.write(baudSetting(self.baud_box.currentText()))
+        self.selectSpecPort()  # Reconnect at the new rate
+
     def takeBlank(self):
         self.is_blank = True
-        self.signal.get_spectrum.emit()
+        spec_Duino.post(spec_Duino.read)
 
     def clearBlank(self):
-        self.applyBlank([np.zeros(2048, float), 0])
+        # The stored blanks go too, or the next spectrum would match one
+        if len(self.darks.stored) > 0:
+            answer = QtGui.QMessageBox.question(
+                self, "Clear Blank", "This also deletes the {} blanks stored "
+                "for other integration times. Clear them all?"
+                .format(len(self.darks.stored)),
+                QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+            if answer != QtGui.QMessageBox.Yes:
+                self.updateMessage("**Clear Blank Cancelled - {}**"
+                                   .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+                return
+        try:
+            self.darks.clear()
+        except OSError as e:
+            self.updateMessage("**Filename Error - Stored Blanks Not All "
+                               "Cleared**\n" + str(e)[:60])
+            print(e)
+        self.applyBlank([np.zeros(len(self.blank_data[0]), float), 0])
         self.updateActiveData()
         self.findFit()
         self.updateMessage("Blank Cleared - {}"
@@ -426,20 +869,67 @@ class Main_Ui_Window(QtGui.QMainWindow):
     def takeSnapshot(self):
         if(self.free_running):
             self.free_running_button.setChecked(False)
-        self.signal.get_spectrum.emit()
+        spec_Duino.post(spec_Duino.read)
         self.updateMessage("Snapshot Initiated - {}"
                            .format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
     def setFreeRunning(self):
         self.free_running = self.free_running_button.isChecked()
+        free_Run.write(self.free_running)
         if self.free_running:
             self.updateMessage("Free-Running Mode Enabled - {}"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
-            self.signal.get_spectrum.emit()
+            spec_Duino.post(spec_Duino.freeRun)
+            self.render_timer.start(int(1000 / self.plot_rate_box.value()))
         else:
+            self.render_timer.stop()
+            self.renderData()  # Draw whatever arrived after the last redraw
             self.updateMessage("Free-Running Mode Disabled - {}"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
+    def setAveraging(self):
+        averaging.write([self.average_mode_box.currentText(),
+                         self.average_count_box.value(),
+                         self.device_sum_button.isChecked()])
+        message = ("Averaging set to {} - {}"
+                   .format(self.average_mode_box.currentText(),
+                           time.strftime("%Y-%m-%d %H:%M:%S")))
+        if self.device_sum_button.isChecked() and \
+           self.average_count_box.value() > MAX_DEVICE_SUM:
+            message += ("\n*The Arduino Sums at Most {} Spectra at a Time*"
+                        .format(MAX_DEVICE_SUM))
+        self.updateMessage(message)
+
+    def setPlotRate(self):
+        if self.render_timer.isActive():
+            self.render_timer.start(int(1000 / self.plot_rate_box.value()))
+
+    # Profiling starts afresh each time it is turned on
+    def setProfiling(self):
+        profiling = self.profile_button.isChecked()
+        stage_Profiler.reset()
+        stage_Profiler.enabled = profiling
+        self.profile_panel.setText("Waiting for Spectra...")
+        self.profile_panel.setVisible(profiling)
+        self.save_profile_button.setEnabled(profiling)
+
+    def saveProfile(self):
+        save_path = (QtGui.QFileDialog.getSaveFileName(
+                     self, "Add Profile To", "Profile.log",
+                     "Log Files (*.log);;All Files (*.*)"))
+        if len(save_path) == 0:
+            self.updateMessage("**Save Profile Cancelled - {}**"
+                               .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+            return
+        try:
+            stage_Profiler.export(save_path)
+            self.updateMessage("Profile Saved - {}"
+                               .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+        except OSError as e:
+            self.updateMessage("**Filename Error - Profile May Have Not "
+                               "Saved Properly**\n" + str(e)[:60])
+            print(e)
+
     def saveCurve(self):
         was_free_running = False
         if(self.free_running):
@@ -448,26 +938,27 @@ class Main_Ui_Window(QtGui.QMainWindow):
         default_path = time.strftime("%Y-%m-%d_%H:%M:%S")
         save_path = (QtGui.QFileDialog.getSaveFileName(
                      self, "Save File As", default_path,
-                     "Spectrum Files (*.csv);;All Files (*.*)"))
+                     "Spectrum Files (*.csv);;Binary Spectrum Files (*.spc);;"
+                     "All Files (*.*)"))
         if len(save_path) == 0:
             self.updateMessage("**Save Spectrum Cancelled - {}**"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
             if was_free_running:
                 self.free_running_button.setChecked(True)
             return
-        if save_path[-4:] != ".csv":
+        if save_path[-4:] not in [".csv", ".spc"]:
             save_path = save_path + ".csv"
         try:
-            with open(save_path, 'wt') as save_file:
-                header = self.generateHeader()
-                save_file.write(header)
-                writer = csv.writer(save_file, dialect="excel-tab")
-                cal = self.active_data[0]
-                dat = self.active_data[1]
-                blank = self.blank_data[0]
-                for rownum in range(len(cal)):
-                    row = [cal[rownum], dat[rownum], blank[rownum]]
-                    writer.writerow(row)
+            if save_path[-4:] == ".spc":
+                info = None
+                if self.peaks is not None:
+                    info = {"peaks": self.peaks[:, 1:3].tolist()}
+                spc_file = createSpectrumFile(save_path, self.active_data[0],
+                                              self.blank_data[0], info=info)
+                spc_file.append(self.active_data[1], self.generateMetadata())
+                spc_file.close()
+            else:
+                self.writeCsv(save_path)
             self.updateMessage("Spectrum Saved - {}"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
         except OSError as e:
@@ -481,6 +972,92 @@ class Main_Ui_Window(QtGui.QMainWindow):
         if was_free_running:
             self.free_running_button.setChecked(True)
 
+    def writeCsv(self, save_path):
+        writeSpectrumCsv(save_path, self.generateHeader(), self.active_data[0],
+                         self.active_data[1], self.blank_data[0])
+
+    def setRecording(self):
+        if not self.record_button.isChecked():
+            if spectrum_Recorder.recording:
+                spectrum_Recorder.stopRecording()
+                self.updateMessage("Recording Stopped - {}"
+                                   .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+            return
+        if spectrum_Recorder.isRunning():
+            self.updateMessage("**The Last Recording is Still Being Written "
+                               "- Please Wait**")
+            self.record_button.setChecked(False)
+            return
+        default_path = time.strftime("%Y-%m-%d_%H:%M:%S_recording")
+        save_path = (QtGui.QFileDialog.getSaveFileName(
+                     self, "Record Spectra To", default_path,
+                     "Binary Spectrum Files (*.spc);;All Files (*.*)"))
+        if len(save_path) == 0:
+            self.updateMessage("**Recording Cancelled - {}**"
+                               .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+            self.record_button.setChecked(False)
+            return
+        if save_path[-4:] != ".spc":
+            save_path = save_path + ".spc"
+        spectrum_Recorder.startRecording(save_path, self.active_data[0],
+                                         self.blank_data)
+        self.record_timer.start(500)
+        self.updateMessage("Recording Started - {}"
+                           .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    def setSequence(self):
+        if not self.sequence_button.isChecked():
+            sequence_Run.write(False)  # The sequence stops after this frame
+            return
+        if self.free_running:
+            self.free_running_button.setChecked(False)
+        i_times = sequencePlan(self.sequence_mode_box.currentText(),
+                               self.i_time_box.value(),
+                               self.sequence_count_box.value())
+        sequence_Job.write([i_times,
+                            self.sequence_interval_box.value() / 1000.])
+        sequence_Run.write(True)
+        spec_Duino.post(spec_Duino.runSequence)
+        self.updateMessage("{} of {} Spectra Started - {}"
+                           .format(self.sequence_mode_box.currentText(),
+                                   len(i_times),
+                                   time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    def sequenceDone(self):
+        self.sequence_button.setChecked(False)
+        spectra, metadata = sequence_Data.read()
+        self.updateMessage("Sequence Finished with {} Spectra - {}"
+                           .format(len(spectra),
+                                   time.strftime("%Y-%m-%d %H:%M:%S")))
+        if len(spectra) == 0:
+            return
+        default_path = time.strftime("%Y-%m-%d_%H:%M:%S_sequence")
+        save_path = (QtGui.QFileDialog.getSaveFileName(
+                     self, "Save Sequence To", default_path,
+                     "Binary Spectrum Files (*.spc);;All Files (*.*)"))
+        if len(save_path) == 0:
+            self.updateMessage("**Sequence Not Saved - {}**"
+                               .format(time.strftime("%Y-%m-%d %H:%M:%S")))
+            return
+        if save_path[-4:] != ".spc":
+            save_path = save_path + ".spc"
+        try:
+            info = {"blank_i_time": int(self.blank_data[1]),
+                    "sequence": self.sequence_mode_box.currentText()}
+            spc_file = createSpectrumFile(save_path, self.active_data[0],
+                                          self.blank_data[0], info=info)
+            spc_file.append(spectra, metadata)
+            spc_file.close()
+            self.updateMessage("Sequence Saved to {}".format(save_path))
+        except OSError as e:
+            self.updateMessage("**Filename Error - Sequence Not Saved**\n" +
+                               str(e)[:60])
+            print(e)
+        except Exception as e:
+            self.updateMessage("**Unknown Error - Sequence Not Saved**\n" +
+                               str(e)[:60])
+            print(e)
+
     def loadCurve(self):
         was_free_running = False
         if(self.free_running):
@@ -488,36 +1065,50 @@ class Main_Ui_Window(QtGui.QMainWindow):
             was_free_running = True
         load_path = (QtGui.QFileDialog.getOpenFileName(
                      self, "Select a Spectrum to Load", "",
-                     "Spectrum Files (*.csv);;All Files (*.*)"))
+                     "Spectrum Files (*.csv *.spc);;All Files (*.*)"))
         if len(load_path) == 0:
             self.updateMessage("**Spectrum Loading Cancelled - {}**"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
             if was_free_running:
                 self.free_running_button.setChecked(True)
             return
-        self.importCurve(load_path)
+        index = -1
+        if load_path[-4:] == ".spc":  # Binary files may hold many spectra
+            try:
+                count = Spectrum_File(load_path).count()
+            except Exception as e:
+                count = 0
+                print(e)
+            if count > 1:
+                index, accepted = QtGui.QInputDialog.getInt(
+                    self, "Select a Spectrum", "This file holds {} spectra. "
+                    "Load spectrum number:".format(count), count - 1, 0,
+                    count - 1)
+                if not accepted:
+                    index = -1
+        self.importCurve(load_path, index)
         self.loadToConfig(load_path)
         if was_free_running:
             self.free_running_button.setChecked(True)
 
     # These functions load data from files
-    def importCalibration(self, load_path):
+    def importCalibration(self, load_path, loaded=None):
         try:
-            with open(load_path, "r") as load_file:
-                reader = csv.reader(load_file)
-                new_calibration = np.zeros(2048, float)
-                starting_row = 1
-                for index, row in enumerate(reader):
-                    if index >= starting_row:
-                        new_calibration[index - starting_row] = float(row[1])
-                self.active_data[0] = new_calibration
-                self.fit_data[0] = new_calibration
-                self.curser.setValue(new_calibration[1024])
-                self.findFit()
+            fields, columns = self.readColumns(load_path, loaded)
+            new_calibration = columns[:, 1]
+            if len(new_calibration) != len(self.active_data[1]):
+                raise ValueError("Calibration has {} pixels, not {}"
+                                 .format(len(new_calibration),
+                                         len(self.active_data[1])))
+            self.active_data[0] = new_calibration
+            self.fit_data[0] = new_calibration
+            self.curser.setValue(new_calibration[len(new_calibration) // 2])
+            self.findFit()
             # A calibration file with "Dummy" in the name gives pixel number
-            # (from 0 to 2047). To use it we must allow the plot to expand
+            # (from 0 to n - 1). To use it we must allow the plot to expand
             if "Dummy" in load_path:
-                self.plot_object.setLimits(xMin=-2, xMax=2050)
+                self.plot_object.setLimits(xMin=-2,
+                                           xMax=len(new_calibration) + 2)
                 self.plot_object.setLabel('bottom', 'Pixel', units="")
             # But normally, it is better to constrain zooming on the plot
             else:
@@ -535,19 +1126,50 @@ class Main_Ui_Window(QtGui.QMainWindow):
                                "Loaded Properly**\n" + str(e)[:60])
             print(e)
 
-    def importCurve(self, load_path):
+    # A flat field file has the calibration file layout, with each pixel's
+    # relative responsivity in place of its wavelength
+    def importFlatField(self, load_path, loaded=None):
         try:
-            with open(load_path, "r") as load_file:
-                reader = csv.reader(load_file, dialect='excel-tab')
-                new_calibration = np.zeros(2048, float)
-                new_data = np.zeros(2048, float)
-                starting_row = 15
-                for index, row in enumerate(reader):
-                    if index >= starting_row:
-                        new_calibration[index - starting_row] = float(row[0])
-                        new_data[index - starting_row] = float(row[1])
-                self.loaded_data[0] = new_calibration
-                self.loaded_data[1] = new_data
+            fields, columns = self.readColumns(load_path, loaded)
+            responsivity = columns[:, 1]
+            if len(responsivity) != len(self.active_data[1]):
+                raise ValueError("Flat field has {} pixels, not {}"
+                                 .format(len(responsivity),
+                                         len(self.active_data[1])))
+            self.pipeline.setFlat(responsivity)
+            self.pipeline.rerun()
+            self.updateActiveData()
+            self.findFit()
+            self.updateMessage("Flat Field Loaded Successfully")
+        except OSError as e:
+            self.updateMessage("**Filename Error - Flat Field May Have Not "
+                               "Loaded Properly**\n" + str(e)[:60])
+            print(e)
+        except Exception as e:
+            self.updateMessage("**Unknown Error - Flat Field May Have Not "
+                               "Loaded Properly**\n" + str(e)[:60])
+            print(e)
+
+    # Columns already read by the file loader are passed in as loaded, which
+    # may instead be the error that reading them raised
+    def readColumns(self, load_path, loaded):
+        if loaded is None:
+            return loadColumns(load_path)
+        if isinstance(loaded, Exception):
+            raise loaded
+        return loaded
+
+    # Load a spectrum .csv file, or spectrum number index of a binary file
+    def importCurve(self, load_path, index=-1, loaded=None):
+        try:
+            if load_path[-4:] == ".spc":
+                spc_file = Spectrum_File(load_path)
+                self.loaded_data[0] = np.array(spc_file.calibration())
+                self.loaded_data[1] = np.array(spc_file.spectrum(index), float)
+            else:
+                fields, columns = self.readColumns(load_path, loaded)
+                self.loaded_data[0] = columns[:, 0]
+                self.loaded_data[1] = columns[:, 1]
             self.updateLoadedData()
             self.updateMessage("Spectrum Loaded - {}"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
@@ -565,98 +1187,94 @@ class Main_Ui_Window(QtGui.QMainWindow):
                                "Loaded Properly**\n" + str(e)[:60])
             print(e)
 
-    # These functions write to the .spec.config file when settings are changed
+    # These functions record settings as they change. The state store is
+    # written a moment after the last change, so a burst of changes costs
+    # only one write.
     def blankToConfig(self):
-        # Try saving the blank data to the spec.config file
-        try:
-            with open(".spec.config", "r") as config_file:
-                lines = config_file.readlines()
-            lines[8] = "Integration Time at Last Blank Taken:\n"
-            lines[9] = str(self.blank_data[1]) + "\n"
-            lines[10] = "Last Blank Taken:"
-            for index, value in enumerate(self.blank_data[0]):
-                lines[11 + index] = "\n" + str(value)
-            with open(".spec.config", "wt") as config_file:
-                config_file.writelines(lines)
-        except OSError as e:
-            self.updateMessage("**Filename Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-        except Exception as e:
-            self.updateMessage("**Unknown Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-            print(e)
+        self.state.setBlank(self.blank_data[0], self.blank_data[1])
+        self.config_timer.start(500)
 
     def loadToConfig(self, load_path):
-        # Try saving the loaded filename to the spec.config file
-        try:
-            with open(".spec.config", "r") as config_file:
-                lines = config_file.readlines()
-            lines[6] = "Spectrum File Last Loaded:\n"
-            lines[7] = str(load_path) + "\n"
-            with open(".spec.config", "wt") as config_file:
-                config_file.writelines(lines)
-        except OSError as e:
-            self.updateMessage("**Filename Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-            print(e)
-        except Exception as e:
-            self.updateMessage("**Unknown Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-            print(e)
+        self.state.update(spectrum_file=str(load_path))
+        self.config_timer.start(500)
 
     def calToConfig(self, load_path):
-        # Try saving the calibration filename to the spec.config file
-        try:
-            with open(".spec.config", "r") as config_file:
-                lines = config_file.readlines()
-            lines[4] = "Calibration File Last Used:\n"
-            lines[5] = str(load_path) + "\n"
-            with open(".spec.config", "wt") as config_file:
-                config_file.writelines(lines)
-        except OSError as e:
-            self.updateMessage("**Filename Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-            print(e)
-        except Exception as e:
-            self.updateMessage("**Unknown Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
-            print(e)
+        self.state.update(calibration_file=str(load_path))
+        self.config_timer.start(500)
 
     def portsToConfig(self):
-        # Try saving the com ports to the spec.config file
+        self.state.update(sensor_port=self.sensor_port_box.currentText(),
+                          spec_port=self.spec_port_box.currentText(),
+                          spec_baud=self.baud_box.currentText())
+        self.config_timer.start(500)
+
+    def saveConfig(self):
         try:
-            with open(".spec.config", "r") as config_file:
-                lines = config_file.readlines()
-            lines[0] = "Sensor Port Last Used:\n"
-            lines[1] = self.sensor_port_box.currentText() + "\n"
-            lines[2] = "Spec Port Last Used:\n"
-            lines[3] = self.spec_port_box.currentText() + "\n"
-            with open(".spec.config", "wt") as config_file:
-                config_file.writelines(lines)
+            self.state.save()
         except OSError as e:
-            self.updateMessage("**Filename Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
+            self.updateMessage("**Filename Error - Settings Not Properly "
+                               "Saved**\n" + str(e)[:60])
             print(e)
         except Exception as e:
-            self.updateMessage("**Unknown Error - spec.config File Not "
-                               "Properly Written**\n" + str(e)[:60])
+            self.updateMessage("**Unknown Error - Settings Not Properly "
+                               "Saved**\n" + str(e)[:60])
             print(e)
 
     # These functions are called when the Arduinos send signals
     def getData(self):  # A signal says there is new data in spectrum object
-        if self.free_running:
-            # Start getting the next spectrum right away
-            self.signal.get_spectrum.emit()
+        # In free running mode the render timer draws the data instead
+        if not self.free_running:
+            self.renderData()
+
+    def renderData(self):  # Draw the newest spectrum in the spectrum object
+        rendering = stage_Profiler.start()
+        newest = spectrum.readNewest()
+        if newest is None:  # An earlier call already took this frame
+            return
+        frame, i_time, sequence, timestamp, skipped = newest
+        # Every spectrum is still recorded, but only the newest is drawn
+        stage_Profiler.count("Skipped", skipped)
+        if spectrum.dropped != self.dropped_frames:  # Overwritten unread
+            stage_Profiler.count("Dropped",
+                                 spectrum.dropped - self.dropped_frames)
+            self.dropped_frames = spectrum.dropped
+        if len(frame) != len(self.active_data[1]):
+            self.applyGeometry(len(frame))
         if self.is_blank:  # The new data must be from a blank
-            self.applyBlank(spectrum.read())
+            self.applyBlank([frame, i_time])
             self.updateMessage("Blank Taken - {}"
                                .format(time.strftime("%Y-%m-%d %H:%M:%S")))
             self.is_blank = False
         else:
-            self.active_data[1:3] = spectrum.read()
-        self.active_data[1] = self.active_data[1] - self.blank_data[0]
+            started = stage_Profiler.start()
+            self.pipeline.run(frame)
+            stage_Profiler.stop("Correct", started)
+            self.active_data[2] = i_time
+            self.matchBlank(self.active_data[2])
+        self.active_sequence = sequence
+        variance = frame_Variance.read()
+        if variance is None:
+            noise = "Noise:  --"
+        else:
+            noise = ("Noise:  {0:.1f} counts"
+                     .format(np.sqrt(np.median(variance))))
+        if self.pipeline.saturated:
+            noise += "  Saturated:  {} px".format(self.pipeline.saturated)
+        self.noise_label.setText(noise)
         self.updateActiveData()
         self.findFit()
+        self.frames_rendered += 1
+        stage_Profiler.stop("Render", rendering)
+        if rendering is not None:  # From acquiring it to drawing it
+            stage_Profiler.record("Spectrum age", time.time() - timestamp)
+        self.updateRates()
+
+    # A signal says the last spectrum did not arrive intact
+    def readFailed(self):
+        stage_Profiler.count("Lost")
+        self.is_blank = False
+        self.updateMessage("**Incomplete Spectrum Received - Frame Discarded "
+                           "- {}**".format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
     # A signal says there is new sensor data in the sensor_Data object
     def getSensorData(self):
@@ -681,41 +1299,118 @@ class Main_Ui_Window(QtGui.QMainWindow):
                       "Data is Being Generated**\n"
         if status[1]:
             message += "Spectrum Arduino Connected Properly"
+            baud, bytes_per_s, frames_per_s, encoding = link_Speed.read()
+            if bytes_per_s is not None:
+                message += ("\nLink: {} - {:.1f} kB/s, {:.1f} Spectra/s, {}"
+                            .format(baud, bytes_per_s / 1000, frames_per_s,
+                                    encoding))
         else:
             message += "**Warning! Spetrum Arduino Could Not Connect - Dummy "\
                        "Data is Being Generated**"
         self.updateMessage(message)
         if status[0] and status[1]:  # only save successfull settings
             self.portsToConfig()
+        self.applyGeometry(detector_Geometry.read()[0])
+        self.pipeline.full_scale = 2**detector_Geometry.read()[1] - 1
+
+    # Size every buffer for an n_pixels detector. This only happens when a
+    # spectrometer with a different pixel count connects.
+    def applyGeometry(self, n_pixels):
+        if n_pixels == len(self.active_data[1]):
+            return
+        calibration = defaultCalibration(n_pixels)
+        self.blank_data = [np.zeros(n_pixels, float), 0]
+        nonlinearity = self.pipeline.nonlinearity
+        self.pipeline = Correction_Pipeline(n_pixels, self.pipeline.full_scale)
+        self.pipeline.nonlinearity = nonlinearity
+        self.active_data = [calibration, self.pipeline.corrected,
+                            self.active_data[2]]
+        self.fit_data = [calibration, np.zeros(n_pixels, float)]
+        self.peak_width_box.setMaximum(n_pixels)
+        message = ("{}-Pixel Detector Connected - {}"
+                   .format(n_pixels, time.strftime("%Y-%m-%d %H:%M:%S")))
+        # The saved calibration and blank may belong to this detector
+        settings, blank = self.state.settings, self.state.blank
+        if settings.get("calibration_file"):
+            self.importCalibration(settings["calibration_file"])
+        if self.active_data[0] is calibration:
+            message += "\n*Please Load a Matching Calibration*"
+        if settings.get("flat_field_file"):
+            self.importFlatField(settings["flat_field_file"])
+        if blank is not None and len(blank) == n_pixels:
+            self.blank_data = [blank, settings.get("blank_i_time", 0)]
+            self.pipeline.dark = blank
+        else:
+            message += "\n*Please Take a New Blank*"
+        self.updateActiveData()
+        self.updateMessage(message)
 
     # Some extra functions for dealing with data
+    # Hand the active data to the fit worker. If it is still busy, this
+    # replaces any spectrum that was already waiting to be fit.
     def findFit(self):
-        amplitude_guess = np.amax(self.active_data[1])
-        center_guess = self.active_data[0][1024]
-        fwhm_guess = 80 * 10.0**-9.0
-        offset_guess = 2.5
-        guesses = [amplitude_guess, center_guess, fwhm_guess, offset_guess]
-        fit_vals, cov = fit(gaussian, self.active_data[0],
-                            self.active_data[1], p0=guesses)
-        self.fit_data[1] = gaussian(self.fit_data[0], fit_vals[0], fit_vals[1],
-                                    fit_vals[2], fit_vals[3])
+        thresholds = None  # None asks for a single peak fit
+        if self.multi_peak_button.isChecked():
+            thresholds = [self.prominence_box.value(),
+                          self.peak_width_box.value()]
+        fit_Job.write([self.active_data[0], self.pipeline.filled(),
+                       self.fit_engine_box.currentText(),
+                       self.active_sequence, thresholds])
+        fit_Worker.post(fit_Worker.fit)
+
+    # A signal says the fit worker has a new result in fit_Result
+    def showFit(self):
+        fit_vals, fit_curve, sequence, peaks = fit_Result.read()
+        if sequence != self.active_sequence:  # A newer spectrum is shown
+            stage_Profiler.count("Stale fits")
+        self.peaks = peaks
+        if peaks is None:
+            self.peaks_label.setText("")
+        else:
+            self.peaks_label.setText("Peaks:  " + "   ".join(
+                "{0:.2f} nm ({1:.2f})".format(center * 10**9, fwhm * 10**9)
+                for center, fwhm in peaks[:, 1:3]))
+        if fit_vals is None:
+            self.center = 0.0
+            self.fwhm = 0.0
+            self.fit_curve.clear()
+            self.center_label.setText("Center:  --")
+            self.fwhm_label.setText("FWHM:  --")
+            return
+        self.fit_data[1] = fit_curve
         self.center = fit_vals[1]
         self.fwhm = fit_vals[2]
+        started = stage_Profiler.start()
         self.fit_curve.setData(self.fit_data[0], self.fit_data[1])
+        stage_Profiler.stop("Plot fit", started)
         self.center_label.setText("Center:  {0:.2f} nm"
                                   .format(self.center * 10**9))
         self.fwhm_label.setText("FWHM:  {0:.2f} nm".format(self.fwhm * 10**9))
+        self.center_label.setToolTip("Center of Best Gaussian Fit to "
+                                     "Spectrum No. {}".format(sequence))
 
+    # Correct the raw spectrum again with the new blank, so there is no old
+    # blank to undo
     def applyBlank(self, new_blank):
-        # First undo the old blank on the currently active data
-        old_blank = self.blank_data
-        self.active_data[1] = self.active_data[1] + old_blank[0]
         self.blank_data = new_blank
+        self.pipeline.dark = new_blank[0]
+        self.pipeline.rerun()
+        if new_blank[1] != 0:  # Keep it for this and nearby times
+            try:
+                self.darks.add(new_blank[0], new_blank[1], self.temp)
+            except OSError as e:
+                self.updateMessage("**Filename Error - Blank Not Added to "
+                                   "the Library**\n" + str(e)[:60])
+                print(e)
         self.blankToConfig()
 
     # Some functions that update the ui
     def updateActiveData(self):
-        self.active_curve.setData(self.active_data[0], self.active_data[1])
+        # Saturated pixels are NaN, and are left as gaps in the curve
+        started = stage_Profiler.start()
+        self.active_curve.setData(self.active_data[0], self.active_data[1],
+                                  connect="finite")
+        stage_Profiler.stop("Plot", started)
 
     def updateLoadedData(self):
         self.loaded_curve.setData(self.loaded_data[0], self.loaded_data[1])
@@ -723,207 +1418,90 @@ class Main_Ui_Window(QtGui.QMainWindow):
     def updateMessage(self, message):
         self.message_label.setText(message)
 
-    def generateHeader(self):
-        header = ("This spectrum was collected on:\t" +
-                  time.strftime("%Y-%m-%d\t%H:%M:%S\n"))
-        header += "Integration Time:\t{}\tms\n".format(self.active_data[2])
-        header += "------------------------\n"
-        header += "Environmental Parameters\n"
-        header += "------------------------\n"
-        header += "Temp:\t{0:.2f}\tdegrees C\n".format(self.temp)
-        header += "Humidity:\t{0:.2f}\t%\n".format(self.humidity)
-        header += "Pressure:\t{0:.2f}\tpa\n".format(self.pressure)
-        header += "--------------\n"
-        header += "Fit Parameters\n"
-        header += "--------------\n"
-        header += "Center:\t{0:.3e}\tm\n".format(self.center)
-        header += "FWHM:\t{0:.2e}\tm\n\n".format(self.fwhm)
-        header += "Wavelength (m)\tCorrected Signal\tApplied Blank\n"
-        return header
-
-
-# These mutex objects communicate between asynchronous arduino and gui threads
-class Spectrum(QtCore.QMutex):
-
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.value = [np.zeros(2048, float), 5]
-
-    def read(self):
-        return self.value
-
-    def write(self, new_value):
-        self.lock()
-        self.value = new_value
-        self.unlock()
-
-
-class Sensor_Data(QtCore.QMutex):
-
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.value = [0.0, 0.0, 0.0]  # temp, humidity, pressure
-
-    def read(self):
-        return self.value
-
-    def write(self, new_value):
-        self.lock()
-        self.value = new_value
-        self.unlock()
-
-
-class I_Time(QtCore.QMutex):
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.value = 5
-
-    def read(self):
-        return self.value
-
-    def write(self, new_value):
-        self.lock()
-        self.value = new_value
-        self.unlock()
-
-
-class Com_Port(QtCore.QMutex):
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.value = None
-
-    def read(self):
-        return self.value
-
-    def write(self, new_value):
-        self.lock()
-        self.value = new_value
-        self.unlock()
-
-
-class Port_Status(QtCore.QMutex):
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.value = [False, False]  # Connection status of sensor, spec ports
-
-    def read(self):
-        return self.value
-
-    def write(self, new_value):
-        self.lock()
-        self.value = new_value
-        self.unlock()
-
-
-# These classes handle the communication between arduinos
-class Outbound_Signal(QtCore.QObject):
-    get_spectrum = QtCore.pyqtSignal()
-    get_sensors = QtCore.pyqtSignal()
-    set_spec_port = QtCore.pyqtSignal()
-    set_sensor_port = QtCore.pyqtSignal()
-
-
-class Sensor_Duino(QtCore.QObject):
-    updated = QtCore.pyqtSignal()
-    connected = QtCore.pyqtSignal()
-    port = None
-    valid_connection = False
-
-    def read(self):
-        if not self.valid_connection:  # Generate dummy data
-            data = np.random.uniform(0, 12, 3)
-        else:  # Get data from the Arduino
-            self.port.write('r')
-            raw_vals = self.port.readline()
-            data = np.fromstring(raw_vals, dtype=float, sep=',')
-        sensor_Data.write(data)
-        self.updated.emit()
-
-    def connectPort(self):
-        status = port_Status.read()
-        self.closePort()
-        try:
-            self.port = serial.Serial(port=sensor_Port.read(), baudrate=9600,
-                                      timeout=2)
-            print("Connecting to the Sensor_Duino on port " +
-                  str(sensor_Port.read()))
-            status[0] = True
-            self.valid_connection = True
-        except Exception as e:
-            print(e)
-            status[0] = False
-            self.valid_connection = False
-        port_Status.write(status)
-        self.connected.emit()
-
-    def closePort(self):
-        print("Closing Sensor port if open")
-        try:
-            self.port.close()
-        except Exception as e:
-            print(e)
-
-
-class Spec_Duino(QtCore.QObject):
-    updated = QtCore.pyqtSignal()
-    connected = QtCore.pyqtSignal()
-    port = None
-    valid_connection = False
-
-    def read(self):
-        i_time = str(i_Time.read()) + " "
-        if not self.valid_connection:
-            # this generates a random gaussian dummy spectrum
-            amp = 3000. + np.random.random() * 1000
-            center = 875. + np.random.random() * 300
-            fwhm = 300. + np.random.random() * 100
-            offset = np.random.random() * 4
-            data = np.random.uniform(0, 100, 2048)
-            data = data + gaussian(np.arange(2048), amp, center, fwhm, offset)
-        else:  # Get real data from the arduino
-            data = np.zeros(2048)
-            self.port.write(i_time.encode())
-            stream = self.port.read(4096)
-            for i in range(2048):
-                data[i] = stream[2*i] << 8 | stream[2*i+1]
-        spectrum.write([data, i_time])
-        self.updated.emit()
-
-    def connectPort(self):
-        status = port_Status.read()
-        self.closePort()
-        try:
-            self.port = serial.Serial(port=spec_Port.read(), baudrate=115200,
-                                      timeout=2)
-            print("Connecting to the Spec_Duino on port " +
-                  str(spec_Port.read()))
-            response = str(self.port.readline())
-            if "Spec" not in response:
-                print('Response on the Serial Port:{}'.format(response))
-                #raise ConnectionError("Spec Arduino may not be running proper "
-                #                      "firmware")
-            # Sometimes an errant extra "Spec" appears in the input buffer
-            self.port.readline()  # This clears "Spec" or waits 2s to timeout
-            status[1] = True
-            self.valid_connection = True
-        except Exception as e:
-            print(e)
-            status[1] = False
-            self.valid_connection = False
-        port_Status.write(status)
-        self.connected.emit()
-
-    def closePort(self):
-        print("Closing Spec port if open")
-        try:
-            self.port.close()
-        except Exception as e:
-            print(e)
-
+    def updateRecording(self):
+        recorder = spectrum_Recorder
+        self.record_label.setText("{0}:  {1} Written  {2} Queued  {3} Dropped"
+                                  .format("Recording" if recorder.recording
+                                          else "Finishing", recorder.written,
+                                          recorder.frames.qsize(),
+                                          recorder.dropped))
+        if recorder.error is not None:
+            self.updateMessage("**Recording Error - Spectra May Have Not "
+                               "Saved Properly**\n" + recorder.error[:60])
+            recorder.error = None
+            self.record_button.setChecked(False)
+        if not recorder.isRunning():
+            self.record_timer.stop()
+            self.record_label.setText("Not Recording - {} Written, {} Dropped"
+                                      .format(recorder.written,
+                                              recorder.dropped))
+
+    def updateRates(self):  # Refreshes the counters about once per second
+        acquired = spectrum.next_sequence
+        elapsed = time.time() - self.rate_count[2]
+        if elapsed < 1.0:
+            return
+        acquire_rate = (acquired - self.rate_count[0]) / elapsed
+        render_rate = (self.frames_rendered - self.rate_count[1]) / elapsed
+        crc_errors, skipped_bytes, lost_frames = link_Status.read()
+        self.rate_label.setText("Acquired:  {0} ({1:.1f}/s)  Rendered:  {2} "
+                                "({3:.1f}/s)  Dropped:  {4}  Link Errors:  {5}"
+                                .format(acquired, acquire_rate,
+                                        self.frames_rendered, render_rate,
+                                        spectrum.dropped,
+                                        crc_errors + lost_frames))
+        self.rate_count = [acquired, self.frames_rendered, time.time()]
+        self.rate_label.setToolTip(
+            "Spectra Acquired and Drawn, with Rates, and Dropped Unread "
+            "When the Window Fell Behind\nCorrections:  " +
+            ",  ".join("{} {:.1f} us".format(name, seconds * 10**6)
+                       for name, seconds in self.pipeline.timings.items()))
+        if stage_Profiler.enabled:
+            self.profile_panel.setText("\n".join(stage_Profiler.report()))
 
-# Define a lambda function for use in fitting
-def gaussian(x, amp, center, fwhm, offset):
-    return amp * np.exp(-(x-center)**2/(2*fwhm**2)) + offset
+    def generateHeader(self):
+        peaks = None
+        if self.peaks is not None:
+            peaks = self.peaks[:, 1:3]
+        return formatHeader(time.time(), self.active_data[2], self.temp,
+                            self.humidity, self.pressure, self.center,
+                            self.fwhm, peaks)
+
+    # The metadata record saved with the active spectrum in a binary file
+    def generateMetadata(self):
+        record = np.zeros(1, SPECTRUM_METADATA)
+        record[0] = (time.time(), self.active_data[2], self.temp,
+                     self.humidity, self.pressure, self.center, self.fwhm)
+        return record
+
+
+# Core signals are emitted on the worker threads. A relay hands one on to its
+# slot through a queued Qt signal, so the slot runs on the GUI thread. A
+# merging relay sends nothing more while one is still waiting to be
+# delivered, for signals like a new spectrum where the slot only wants the
+# newest, so a fast spectrometer can't flood the GUI thread with events.
+class Core_Relay(QtCore.QObject):
+    fired = QtCore.pyqtSignal(tuple)
+
+    def __init__(self, signal, slot, merge=False):
+        QtCore.QObject.__init__(self)
+        self.slot = slot
+        self.merge = merge
+        self.pending = False
+        self.fired.connect(self.deliver)
+        signal.connect(self.relay)
+
+    def relay(self, *args):
+        if self.merge:
+            if self.pending:
+                return
+            self.pending = True
+        self.fired.emit(args)
+
+    def deliver(self, args):
+        # Cleared first, so anything emitted during the slot is delivered
+        self.pending = False
+        self.slot(*args)
 
 
 def main():
@@ -946,30 +1524,22 @@ def main():
     MainWindow.showMaximized()
     return MainWindow
 
-# Instantiate the application
-app = QtGui.QApplication(sys.argv)
-
-# Generate the mutex objects
-spectrum = Spectrum()
-sensor_Data = Sensor_Data()
-i_Time = I_Time()
-spec_Port = Com_Port()
-sensor_Port = Com_Port()
-port_Status = Port_Status()
-
-# Generate the Arduinos and start them in their own threads
-spec_Duino = Spec_Duino()
-spec_thread = QtCore.QThread()
-spec_Duino.moveToThread(spec_thread)
-spec_thread.start()
-sensor_Duino = Sensor_Duino()
-sensor_thread = QtCore.QThread()
-sensor_Duino.moveToThread(sensor_thread)
-sensor_thread.start()
-
-# Create the GUI and start the application
-main_form = main()
-app.exec_()
+# Only launch the GUI when run as a script
+if __name__ == "__main__":
+    # Instantiate the application
+    app = QtGui.QApplication(sys.argv)
+    startup.mark("Qt started")
+
+    # Start the arduinos, the fitting and the file loading in their own
+    # threads. The mutex objects they share are made in Spectrometer_Core.
+    for worker in [spec_Duino, sensor_Duino, fit_Worker, file_Loader]:
+        worker.startThread()
+    startup.mark("Threads started")
+
+    # Create the GUI and start the application
+    main_form = main()
+    startup.mark("Window built")
+    app.exec_()
 
 # ToDo: Implement integration time in bytes if possible
 